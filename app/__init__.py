@@ -2,12 +2,12 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from config import Config
+from app.routing import RoutingSQLAlchemy
 from flask_avatars import Avatars
 from flask_moment import Moment
 from flask_babel import Babel
@@ -16,7 +16,7 @@ from elasticsearch import Elasticsearch
 
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 login = LoginManager(app)
 login.login_view = "login"
@@ -67,4 +67,18 @@ if not app.debug:
     app.logger.setLevel(logging.INFO)
     app.logger.info("RoBlog startup")
 
-from app import routes, models, errors
+from app import (
+    engine,
+    routes,
+    models,
+    errors,
+    timeline,
+    conditional,
+    ranking,
+    identicons,
+    identity,
+    metrics,
+    replica,
+    api,
+    cli,
+)
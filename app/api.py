@@ -0,0 +1,199 @@
+from datetime import datetime
+from flask import Blueprint, abort, jsonify, request
+from flask_login import current_user
+from app import app, db
+from app.models import User, Post, Comment, Community
+from app.pagination import keyset_paginate
+from app.replica import use_replica
+
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+
+class Resource(object):
+    def __init__(self, model, fields, order, joins=None, filters=()):
+        self.model = model
+        self.fields = fields
+        self.order = order
+        self.joins = joins or {}
+        self.filters = filters
+
+
+RESOURCES = {
+    "posts": Resource(
+        Post,
+        {
+            "id": Post.id,
+            "body": Post.body,
+            "timestamp": Post.timestamp,
+            "karma": Post.karma,
+            "comment_count": Post.comment_count,
+            "user_id": Post.user_id,
+            "community_id": Post.communityid,
+            "author": User.username,
+            "community": Community.name,
+        },
+        (Post.timestamp, Post.id),
+        joins={
+            "author": (User, Post.user_id == User.id),
+            "community": (Community, Post.communityid == Community.id),
+        },
+        filters=("user_id", "community_id"),
+    ),
+    "users": Resource(
+        User,
+        {
+            "id": User.id,
+            "username": User.username,
+            "about_me": User.about_me,
+            "last_seen": User.last_seen,
+            "karma": User.karma,
+        },
+        (User.id,),
+    ),
+    "comments": Resource(
+        Comment,
+        {
+            "id": Comment.id,
+            "body": Comment.body,
+            "timestamp": Comment.timestamp,
+            "karma": Comment.karma,
+            "post_id": Comment.post_id,
+            "parent_id": Comment.parent_id,
+            "descendant_count": Comment.descendant_count,
+            "reply_count": Comment.reply_count,
+            "author_id": Comment.author_id,
+            "author": User.username,
+        },
+        (Comment.timestamp, Comment.id),
+        joins={"author": (User, Comment.author_id == User.id)},
+        filters=("post_id", "author_id"),
+    ),
+    "communities": Resource(
+        Community,
+        {
+            "id": Community.id,
+            "name": Community.name,
+            "about": Community.about,
+            "member_count": Community.member_count,
+        },
+        (Community.id,),
+    ),
+}
+
+
+def error(status: int, message: str):
+    response = jsonify({"error": message})
+    response.status_code = status
+    return response
+
+
+@bp.before_request
+def require_login():
+    if not current_user.is_authenticated:
+        return error(401, "authentication required")
+
+
+@bp.errorhandler(400)
+def bad_request(e):
+    return error(400, e.description)
+
+
+@bp.errorhandler(404)
+def not_found(e):
+    return error(404, "not found")
+
+
+def get_resource(name: str):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        abort(404)
+    return resource
+
+
+def selected_fields(resource):
+    fields = request.args.get("fields")
+    if not fields:
+        return list(resource.fields)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in resource.fields]
+    if unknown:
+        abort(400, "unknown fields: " + ", ".join(unknown))
+    return names
+
+
+def select(resource, names):
+    columns = [resource.fields[name].label(name) for name in names]
+    keys = [c.label("_key%d" % i) for i, c in enumerate(resource.order)]
+    query = db.session.query(*columns, *keys).select_from(resource.model)
+    for name in names:
+        if name in resource.joins:
+            query = query.outerjoin(*resource.joins[name])
+    return query
+
+
+def serialize(row, names):
+    return {
+        name: value.isoformat() if isinstance(value, datetime) else value
+        for name, value in zip(names, row)
+    }
+
+
+def parse_ids(raw: str):
+    try:
+        ids = [int(id) for id in raw.split(",") if id.strip()]
+    except ValueError:
+        abort(400, "ids must be integers")
+    if len(ids) > app.config["API_MAX_PER_PAGE"]:
+        abort(400, "at most {} ids".format(app.config["API_MAX_PER_PAGE"]))
+    return ids
+
+
+@bp.route("/<name>")
+@use_replica
+def collection(name: str):
+    resource = get_resource(name)
+    names = selected_fields(resource)
+    query = select(resource, names)
+    if request.args.get("ids"):
+        ids = parse_ids(request.args["ids"])
+        query = query.add_columns(resource.model.id.label("_id"))
+        rows = {row._id: row for row in query.filter(resource.model.id.in_(ids))}
+        return jsonify(
+            {"items": [serialize(rows[id], names) for id in ids if id in rows]}
+        )
+    for field in resource.filters:
+        value = request.args.get(field, type=int)
+        if value is not None:
+            query = query.filter(resource.fields[field] == value)
+    per_page = min(
+        request.args.get("limit", app.config["API_PER_PAGE"], type=int),
+        app.config["API_MAX_PER_PAGE"],
+    )
+    page = keyset_paginate(
+        query,
+        resource.order,
+        key=lambda row: tuple(row[len(names) :]),
+        per_page=max(per_page, 1),
+    )
+    return jsonify(
+        {
+            "items": [serialize(row, names) for row in page.items],
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
+        }
+    )
+
+
+@bp.route("/<name>/<int:id>")
+@use_replica
+def item(name: str, id: int):
+    resource = get_resource(name)
+    names = selected_fields(resource)
+    row = select(resource, names).filter(resource.model.id == id).first()
+    if row is None:
+        abort(404)
+    return jsonify(serialize(row, names))
+
+
+app.register_blueprint(bp)
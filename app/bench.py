@@ -0,0 +1,192 @@
+import math
+import random
+import tracemalloc
+from time import perf_counter
+from app import app, db
+from app.models import User, Post, Comment, Community, followers
+from app.export import ndjson, gzipped
+
+
+ROUTES = {
+    "index": "/index",
+    "explore": "/explore",
+    "user": "/user/{celebrity}",
+    "post": "/post/{post}",
+    "community": "/community/{community}",
+    "messages": "/messages",
+    "vote": "/{post}/+",
+    "vote_comment": "/comment/{comment}/+",
+}
+
+
+class StatementRecorder(object):
+    def __init__(self):
+        self.statements = []
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        db.event.listen(db.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(db.engine, "before_cursor_execute", self.record)
+
+
+class ScanCounter(object):
+    def __init__(self):
+        self.plans = {}
+
+    def scans(self, statement, parameters):
+        if db.engine.dialect.name != "sqlite" or not statement.startswith("SELECT"):
+            return 0
+        if statement not in self.plans:
+            with db.engine.connect() as conn:
+                rows = conn.exec_driver_sql(
+                    "EXPLAIN QUERY PLAN " + statement, parameters
+                ).fetchall()
+            self.plans[statement] = sum(
+                1
+                for row in rows
+                if row[-1].startswith("SCAN ") and "CONSTANT ROW" not in row[-1]
+            )
+        return self.plans[statement]
+
+
+def percentile(samples, p: float):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def pick_reader():
+    return (
+        db.session.query(followers.c.follower_id)
+        .group_by(followers.c.follower_id)
+        .order_by(db.func.count().desc())
+        .limit(1)
+        .scalar()
+    )
+
+
+def pick_celebrity():
+    return (
+        db.session.query(User.username)
+        .join(followers, followers.c.followed_id == User.id)
+        .group_by(User.id)
+        .order_by(db.func.count().desc())
+        .limit(1)
+        .scalar()
+    )
+
+
+def pick_author():
+    return (
+        db.session.query(Post.user_id)
+        .group_by(Post.user_id)
+        .order_by(db.func.count().desc())
+        .limit(1)
+        .scalar()
+    )
+
+
+def recent_ids(model, limit: int = 500):
+    return [
+        id
+        for (id,) in db.session.query(model.id).order_by(model.id.desc()).limit(limit)
+    ]
+
+
+def run(
+    routes=None,
+    iterations: int = 50,
+    warmup: int = 2,
+    username=None,
+    random_seed: int = 0,
+):
+    rng = random.Random(random_seed)
+    if username:
+        reader = User.query.filter_by(username=username).one().id
+    else:
+        reader = pick_reader()
+    context = {
+        "celebrity": pick_celebrity(),
+        "post": recent_ids(Post),
+        "comment": recent_ids(Comment),
+        "community": recent_ids(Community),
+    }
+    db.session.remove()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(reader)
+        session["_fresh"] = True
+    counter = ScanCounter()
+    results = {}
+    for name in routes or ROUTES:
+        samples, queries, scans = [], [], []
+        for i in range(warmup + iterations):
+            url = ROUTES[name].format(
+                **{
+                    key: rng.choice(value) if isinstance(value, list) else value
+                    for key, value in context.items()
+                    if value
+                }
+            )
+            with StatementRecorder() as recorder:
+                start = perf_counter()
+                response = client.get(url, headers={"Referer": "/index"})
+                elapsed = perf_counter() - start
+            if response.status_code >= 400:
+                raise RuntimeError("{} returned {}".format(url, response.status_code))
+            if i < warmup:
+                continue
+            samples.append(elapsed)
+            queries.append(len(recorder.statements))
+            scans.append(sum(counter.scans(*s) for s in recorder.statements))
+        results[name] = {
+            "requests": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "queries": sum(queries) / len(queries),
+            "max_queries": max(queries),
+            "scans": sum(scans) / len(scans),
+        }
+    return results
+
+
+def export_throughput(username=None, gzip: bool = False):
+    if username:
+        user_id = User.query.filter_by(username=username).one().id
+    else:
+        user_id = pick_author()
+    counts = {"rows": 0}
+
+    def drain():
+        counts["rows"] = 0
+        chunks = counted(ndjson(user_id))
+        return sum(len(chunk) for chunk in (gzipped(chunks) if gzip else chunks))
+
+    def counted(chunks):
+        for chunk in chunks:
+            counts["rows"] += chunk.count(b"\n")
+            yield chunk
+
+    # Time a plain pass; tracing allocations slows the export several-fold.
+    start = perf_counter()
+    size = drain()
+    elapsed = perf_counter() - start
+    tracemalloc.start()
+    try:
+        drain()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "user_id": user_id,
+        "rows": counts["rows"],
+        "bytes": size,
+        "seconds": elapsed,
+        "rows_per_second": counts["rows"] / elapsed if elapsed else 0.0,
+        "peak_kb": peak / 1024,
+    }
@@ -0,0 +1,219 @@
+import json
+import time
+import click
+from app import app, db
+from app.models import User, Post, Conversation, Notification
+from app import timeline
+from app.votes import apply_votes
+from app.identicons import pregenerate
+from app import bench as benchmark
+from app.seed import seed as seed_data
+from app.export import export as export_records
+from app import ranking
+
+
+@app.cli.group("timeline")
+def timeline_cli():
+    """Materialized home timeline commands."""
+    pass
+
+
+@timeline_cli.command("rebuild")
+@click.option("--user", "username", default=None, help="Rebuild a single user.")
+def rebuild(username):
+    """Rebuild timelines from the followed_posts union."""
+    query = User.query.with_entities(User.id)
+    if username:
+        query = query.filter_by(username=username)
+    for (user_id,) in query.all():
+        timeline.rebuild(db.session.connection(), user_id)
+        db.session.commit()
+
+
+@app.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+
+@counters.command()
+def repair():
+    """Recompute conversations, unread message and comment counters."""
+    conversations = Conversation.rebuild()
+    users = User.recount_unread_messages()
+    posts = Post.recount_comments()
+    db.session.commit()
+    click.echo(
+        "Recounted {} users, {} conversation members and {} posts.".format(
+            users, conversations, posts
+        )
+    )
+
+
+@app.cli.group()
+def votes():
+    """Vote ingestion commands."""
+    pass
+
+
+@votes.command()
+@click.argument("source", type=click.File("r"))
+def replay(source):
+    """Apply a JSON-lines vote stream in one transaction."""
+    stream = [json.loads(line) for line in source if line.strip()]
+    accepted = apply_votes(stream)
+    click.echo("Applied {} of {} votes.".format(accepted, len(stream)))
+
+
+@app.cli.group("ranking")
+def ranking_cli():
+    """Stored feed ranking commands."""
+    pass
+
+
+@ranking_cli.command()
+@click.option("--batch-size", default=None, type=int, help="Posts per update.")
+@click.option("--every", default=0, help="Repeat every N seconds.")
+def decay(batch_size, every):
+    """Recompute hot scores for posts inside the ranking horizon."""
+    while True:
+        live, expired = ranking.decay(batch_size)
+        click.echo("Rescored {} posts, expired {}.".format(live, expired))
+        if not every:
+            break
+        time.sleep(every)
+
+
+@app.cli.group("notifications")
+def notifications_cli():
+    """Notification maintenance commands."""
+    pass
+
+
+@notifications_cli.command()
+@click.option("--batch-size", default=None, type=int, help="Rows per delete.")
+@click.option("--every", default=0, help="Repeat every N seconds.")
+def compact(batch_size, every):
+    """Delete notifications older than NOTIFICATION_TTL."""
+    while True:
+        deleted = Notification.compact(batch_size)
+        click.echo("Deleted {} expired notifications.".format(deleted))
+        if not every:
+            break
+        time.sleep(every)
+
+
+@app.cli.command()
+@click.option("--chunk-size", default=1000, help="Posts per bulk request.")
+def reindex(chunk_size):
+    """Stream all posts into the search index."""
+    click.echo("Indexed {} posts.".format(Post.reindex(chunk_size)))
+
+
+@app.cli.group()
+def avatars():
+    """Identicon avatar commands."""
+    pass
+
+
+@avatars.command()
+@click.option("--chunk-size", default=1000, help="Users per batch.")
+def generate(chunk_size):
+    """Pre-render every avatar size and format for all users."""
+    last, total = 0, 0
+    while True:
+        ids = [
+            user_id
+            for (user_id,) in User.query.with_entities(User.id)
+            .filter(User.id > last)
+            .order_by(User.id)
+            .limit(chunk_size)
+        ]
+        if not ids:
+            break
+        total += pregenerate(ids)
+        last = ids[-1]
+    click.echo("Generated {} avatar images.".format(total))
+
+
+@app.cli.command()
+@click.argument("username")
+@click.option("--output", type=click.File("wb"), default="-", help="Default: stdout.")
+@click.option("--gzip", is_flag=True, help="Compress the NDJSON stream.")
+def export(username, output, gzip):
+    """Stream a user's posts, comments, messages and votes as NDJSON."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException("No user named " + username)
+    for chunk in export_records(user.id, gzip):
+        output.write(chunk)
+
+
+@app.cli.group()
+def bench():
+    """Synthetic data and route benchmark commands."""
+    pass
+
+
+@bench.command()
+@click.option("--users", default=200)
+@click.option("--posts", default=2000)
+@click.option("--comments", default=5000)
+@click.option("--votes", default=10000)
+@click.option("--messages", default=1000)
+@click.option("--communities", default=10)
+@click.option("--follows", default=20, help="Follows per user besides celebrities.")
+@click.option("--celebrities", default=5, help="Accounts half the site follows.")
+@click.option("--skew", default=1.1, help="Zipf exponent for activity.")
+@click.option("--seed", "random_seed", default=0)
+def seed(**options):
+    """Fill the database with a synthetic, skewed data set."""
+    counts = seed_data(**options)
+    click.echo(", ".join("{} {}".format(n, name) for name, n in counts.items()))
+
+
+@bench.command()
+@click.option("--route", "routes", multiple=True, type=click.Choice(benchmark.ROUTES))
+@click.option("--iterations", default=50, type=click.IntRange(min=1))
+@click.option("--warmup", default=2)
+@click.option("--user", "username", default=None, help="Defaults to the top follower.")
+@click.option("--json", "output", type=click.File("w"), help="Write results as JSON.")
+@click.option("--max-queries", type=int, help="Fail if any route exceeds this.")
+def run(routes, iterations, warmup, username, output, max_queries):
+    """Drive the hot routes and report latency and query costs."""
+    results = benchmark.run(routes, iterations, warmup, username)
+    line = "{:<14}{:>6}{:>10}{:>10}{:>9}{:>8}{:>7}"
+    click.echo(line.format("route", "n", "p50 ms", "p99 ms", "queries", "max", "scans"))
+    for name, r in results.items():
+        click.echo(
+            line.format(
+                name,
+                r["requests"],
+                "%.1f" % r["p50_ms"],
+                "%.1f" % r["p99_ms"],
+                "%.1f" % r["queries"],
+                r["max_queries"],
+                "%.1f" % r["scans"],
+            )
+        )
+    if output:
+        json.dump(results, output, indent=2)
+    over = [
+        name
+        for name, r in results.items()
+        if max_queries and r["max_queries"] > max_queries
+    ]
+    if over:
+        raise click.ClickException("Query budget exceeded: " + ", ".join(over))
+
+
+@bench.command("export")
+@click.option("--user", "username", default=None, help="Defaults to the top poster.")
+@click.option("--gzip", is_flag=True)
+def export_bench(username, gzip):
+    """Measure export throughput and peak memory for one account."""
+    r = benchmark.export_throughput(username, gzip)
+    click.echo(
+        "Exported {rows} rows ({bytes} bytes) for user {user_id} in {seconds:.2f}s: "
+        "{rows_per_second:.0f} rows/s, peak {peak_kb:.0f} KiB".format(**r)
+    )
@@ -1,19 +1,118 @@
 from flask_mail import Message
 from flask import render_template
 from app import app, mail
-from threading import Thread
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+from time import time
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+outbox = []
+
+
+class MailPool(object):
+    def __init__(self, workers: int, maxsize: int):
+        self.queue = Queue(maxsize=maxsize)
+        self.workers = workers
+        self.threads = []
+        self.lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.last_latency = 0.0
+
+    def submit(self, msg):
+        with self.lock:
+            if not self.threads:
+                for _ in range(self.workers):
+                    thread = Thread(target=self.run, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        try:
+            self.queue.put_nowait((msg, time()))
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            app.logger.warning("Mail queue full, dropped email to %s", msg.recipients)
+            return False
+        return True
+
+    def run(self):
+        with app.app_context():
+            connection = None
+            while True:
+                try:
+                    msg, queued = self.queue.get(
+                        timeout=app.config["MAIL_IDLE_TIMEOUT"]
+                    )
+                except Empty:
+                    connection = self.close(connection)
+                    continue
+                try:
+                    connection = self.send(connection, msg)
+                    self.record(queued)
+                except Exception:
+                    connection = None
+                    with self.lock:
+                        self.failed += 1
+                    app.logger.exception("Could not send email to %s", msg.recipients)
+                finally:
+                    self.queue.task_done()
+
+    def send(self, connection, msg):
+        # Servers close idle sessions on their own schedule, so a failure on a
+        # reused connection gets one more try on a fresh one.
+        if connection is not None:
+            try:
+                msg.send(connection)
+                return connection
+            except Exception:
+                self.close(connection)
+                app.logger.info("Reconnecting to send email to %s", msg.recipients)
+        connection = mail.connect().__enter__()
+        try:
+            msg.send(connection)
+        except Exception:
+            self.close(connection)
+            raise
+        return connection
+
+    def close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def record(self, queued: float):
+        with self.lock:
+            self.sent += 1
+            self.last_latency = time() - queued
+            self.latency_total += self.last_latency
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_latency": self.last_latency,
+            "avg_latency": self.latency_total / self.sent if self.sent else 0.0,
+        }
+
+
+pool = MailPool(app.config["MAIL_POOL_SIZE"], app.config["MAIL_QUEUE_SIZE"])
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    if app.config["MAIL_CAPTURE"]:
+        outbox.append(msg)
+    else:
+        pool.submit(msg)
 
 
 def send_password_reset_email(user):
@@ -0,0 +1,60 @@
+import sqlite3
+from sqlalchemy.engine import Engine
+from app import app, db
+
+
+PRAGMAS = (
+    ("journal_mode", "SQLITE_JOURNAL_MODE"),
+    ("synchronous", "SQLITE_SYNCHRONOUS"),
+    ("busy_timeout", "SQLITE_BUSY_TIMEOUT"),
+    ("mmap_size", "SQLITE_MMAP_SIZE"),
+    ("cache_size", "SQLITE_CACHE_SIZE"),
+)
+SYNCHRONOUS = {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}
+
+
+@db.event.listens_for(Engine, "connect")
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma, key in PRAGMAS:
+        cursor.execute("PRAGMA {} = {}".format(pragma, app.config[key]))
+    cursor.close()
+
+
+def profile():
+    engine = db.engine
+    settings = {"dialect": engine.dialect.name, "pool": type(engine.pool).__name__}
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as conn:
+            for pragma, _ in PRAGMAS:
+                settings[pragma] = conn.exec_driver_sql("PRAGMA " + pragma).scalar()
+        settings["synchronous"] = SYNCHRONOUS.get(
+            settings["synchronous"], settings["synchronous"]
+        )
+    else:
+        pool = engine.pool
+        settings.update(
+            pool_size=pool.size() if hasattr(pool, "size") else None,
+            max_overflow=getattr(pool, "_max_overflow", None),
+            pool_recycle=getattr(pool, "_recycle", None),
+            pool_timeout=getattr(pool, "_timeout", None),
+        )
+    return settings
+
+
+@app.before_first_request
+def check_engine():
+    settings = profile()
+    app.logger.info(
+        "Database engine: %s",
+        ", ".join("{}={}".format(key, value) for key, value in settings.items()),
+    )
+    journal_mode = str(settings.get("journal_mode", "")).upper()
+    wanted = app.config["SQLITE_JOURNAL_MODE"].upper()
+    if settings["dialect"] == "sqlite" and journal_mode not in (wanted, "MEMORY"):
+        app.logger.warning(
+            "SQLite journal_mode is %s, expected %s", journal_mode, wanted
+        )
+    return settings
@@ -0,0 +1,97 @@
+import json
+import zlib
+from datetime import datetime
+from sqlalchemy.orm import aliased
+from app import app, db
+from app.models import User, Post, Comment, Message, voted_by, voted_by_comm
+
+
+def sections(user_id: int):
+    sender, recipient = aliased(User), aliased(User)
+    yield "user", db.session.query(
+        User.id, User.username, User.email, User.about_me, User.last_seen, User.karma
+    ).filter(User.id == user_id)
+    yield "post", db.session.query(
+        Post.id,
+        Post.body,
+        Post.timestamp,
+        Post.karma,
+        Post.comment_count,
+        Post.communityid.label("community_id"),
+    ).filter(Post.user_id == user_id).order_by(Post.id)
+    yield "comment", db.session.query(
+        Comment.id,
+        Comment.post_id,
+        Comment.parent_id,
+        Comment.body,
+        Comment.timestamp,
+        Comment.karma,
+    ).filter(Comment.author_id == user_id).order_by(Comment.id)
+    yield "message_sent", db.session.query(
+        Message.id,
+        recipient.username.label("recipient"),
+        Message.body,
+        Message.timestamp,
+    ).join(recipient, Message.recipient_id == recipient.id).filter(
+        Message.sender_id == user_id
+    ).order_by(Message.id)
+    yield "message_received", db.session.query(
+        Message.id,
+        sender.username.label("sender"),
+        Message.body,
+        Message.timestamp,
+    ).join(sender, Message.sender_id == sender.id).filter(
+        Message.recipient_id == user_id
+    ).order_by(Message.id)
+    yield "post_vote", db.session.query(
+        voted_by.c.post_id, voted_by.c.direction
+    ).filter(voted_by.c.user_id == user_id).order_by(voted_by.c.post_id)
+    yield "comment_vote", db.session.query(
+        voted_by_comm.c.comments_id.label("comment_id"), voted_by_comm.c.direction
+    ).filter(voted_by_comm.c.user_id == user_id).order_by(
+        voted_by_comm.c.comments_id
+    )
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+encoder = json.JSONEncoder(default=_default)
+
+
+def records(user_id: int):
+    chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+    for kind, query in sections(user_id):
+        fields = [column["name"] for column in query.column_descriptions]
+        for row in query.yield_per(chunk_size):
+            yield {"type": kind, **dict(zip(fields, row))}
+
+
+def ndjson(user_id: int):
+    buffer, size = [], 0
+    for record in records(user_id):
+        line = encoder.encode(record) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= app.config["EXPORT_BUFFER_SIZE"]:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(user_id: int, gzip: bool = False):
+    chunks = ndjson(user_id)
+    return gzipped(chunks) if gzip else chunks
@@ -0,0 +1,188 @@
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from flask import g, render_template
+from flask_login import current_user
+from markupsafe import Markup
+from app import app
+
+
+class LRUCache(object):
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.keys = {}
+
+    def get(self, owner, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time():
+                self._discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, owner, key, value):
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = (time() + self.ttl, owner, value)
+            self.keys.setdefault(owner, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._discard(next(iter(self.entries)))
+
+    def invalidate(self, owner):
+        with self.lock:
+            for key in list(self.keys.get(owner, ())):
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            keys = self.keys.get(entry[1])
+            keys.discard(key)
+            if not keys:
+                del self.keys[entry[1]]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisCache(object):
+    prefix = "roblog:fragment:"
+
+    def __init__(self, maxsize: int, ttl: float):
+        from redis import Redis
+
+        self.redis = Redis.from_url(app.config["REDIS_URL"])
+        self.ttl = int(ttl)
+
+    def get(self, owner, key):
+        value = self.redis.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+    def set(self, owner, key, value):
+        pipe = self.redis.pipeline()
+        pipe.setex(self.prefix + key, self.ttl, value)
+        pipe.sadd(self.prefix + owner, key)
+        pipe.expire(self.prefix + owner, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, owner):
+        keys = self.redis.smembers(self.prefix + owner)
+        self.redis.delete(
+            self.prefix + owner, *[self.prefix + key.decode() for key in keys]
+        )
+
+
+class FragmentCache(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, kind: str, id: int, version, role: str, render):
+        if self.backend is None:
+            return render()
+        owner = "{}:{}".format(kind, id)
+        digest = hashlib.sha1(repr(version).encode()).hexdigest()
+        key = "{}:{}:{}".format(owner, digest, role)
+        html = self.backend.get(owner, key)
+        hit = html is not None
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        counts = g.setdefault("fragment_cache", [0, 0])
+        counts[0 if hit else 1] += 1
+        if not hit:
+            html = render()
+            self.backend.set(owner, key, html)
+        return html
+
+    def invalidate(self, kind: str, id: int):
+        if self.backend is not None:
+            self.backend.invalidate("{}:{}".format(kind, id))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+BACKENDS = {"memory": LRUCache, "redis": RedisCache, "none": None}
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        backend = BACKENDS[app.config["FRAGMENT_CACHE"]]
+        _cache = FragmentCache(
+            backend(app.config["FRAGMENT_CACHE_SIZE"], app.config["FRAGMENT_CACHE_TTL"])
+            if backend
+            else None
+        )
+    return _cache
+
+
+def invalidate(kind: str, id: int):
+    get_cache().invalidate(kind, id)
+
+
+def _role(author_id: int):
+    if current_user.is_authenticated and current_user.id == author_id:
+        return "author"
+    return "viewer"
+
+
+@app.template_global()
+def render_post(post):
+    version = (
+        post.body,
+        post.karma,
+        post.comment_count,
+        post.timestamp,
+        post.author.username,
+        post.community.name if post.community else None,
+    )
+    return Markup(
+        get_cache().render(
+            "post",
+            post.id,
+            version,
+            _role(post.user_id),
+            lambda: render_template("_post.html", post=post),
+        )
+    )
+
+
+@app.template_global()
+def render_comment(comment):
+    version = (comment.body, comment.karma, comment.timestamp, comment.author.username)
+    return Markup(
+        get_cache().render(
+            "comment",
+            comment.id,
+            version,
+            _role(comment.author_id),
+            lambda: render_template("_comments.html", post=comment),
+        )
+    )
+
+
+@app.after_request
+def fragment_cache_header(response):
+    counts = g.get("fragment_cache")
+    if app.debug and counts:
+        response.headers["X-Fragment-Cache"] = "{} hit, {} miss".format(*counts)
+    return response
@@ -0,0 +1,153 @@
+import hashlib
+import os
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+from flask import abort, make_response, url_for
+from PIL import Image, ImageDraw, features
+from app import app
+
+
+FORMATS = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+GRID = 5
+BACKGROUND = (240, 240, 240)
+
+
+def supported(fmt: str):
+    return fmt == "png" or (fmt == "webp" and features.check("webp"))
+
+
+def identicon(user_id: int, size: int, fmt: str):
+    digest = hashlib.md5(
+        "{}:{}".format(app.config["AVATAR_VERSION"], user_id).encode()
+    ).digest()
+    colour = tuple(64 + b % 160 for b in digest[:3])
+    bits = int.from_bytes(digest[3:], "big")
+    cell = size // (GRID + 1)
+    margin = (size - cell * GRID) // 2
+    image = Image.new("RGB", (size, size), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    for col in range((GRID + 1) // 2):
+        for row in range(GRID):
+            if not bits >> (col * GRID + row) & 1:
+                continue
+            for x in {col, GRID - 1 - col}:
+                draw.rectangle(
+                    [
+                        margin + x * cell,
+                        margin + row * cell,
+                        margin + (x + 1) * cell - 1,
+                        margin + (row + 1) * cell - 1,
+                    ],
+                    fill=colour,
+                )
+    out = BytesIO()
+    image.save(out, FORMATS[fmt][0], optimize=True)
+    return out.getvalue()
+
+
+class MemoryStore(object):
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def set(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class DiskStore(object):
+    def __init__(self, maxsize: int):
+        self.root = app.config["AVATAR_DIR"]
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+STORES = {"memory": MemoryStore, "disk": DiskStore}
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = STORES[app.config["AVATAR_STORE"]](app.config["AVATAR_CACHE_SIZE"])
+    return _store
+
+
+def key(user_id: int, size: int, fmt: str):
+    return "v{}/{}/{}/{}.{}".format(
+        app.config["AVATAR_VERSION"], user_id // 1000, user_id, size, fmt
+    )
+
+
+def get_avatar(user_id: int, size: int, fmt: str):
+    store = get_store()
+    data = store.get(key(user_id, size, fmt))
+    if data is None:
+        data = identicon(user_id, size, fmt)
+        store.set(key(user_id, size, fmt), data)
+    return data
+
+
+def pregenerate(user_ids):
+    formats = [fmt for fmt in FORMATS if supported(fmt)]
+    store, count = get_store(), 0
+    for user_id in user_ids:
+        for size in app.config["AVATAR_SIZES"]:
+            for fmt in formats:
+                if store.get(key(user_id, size, fmt)) is None:
+                    store.set(key(user_id, size, fmt), identicon(user_id, size, fmt))
+                    count += 1
+    return count
+
+
+@app.template_global()
+def avatar_url(user_id: int, size: int):
+    fmt = app.config["AVATAR_FORMAT"]
+    if not supported(fmt):
+        fmt = "png"
+    return url_for(
+        "avatar",
+        user_id=user_id,
+        size=size,
+        fmt=fmt,
+        v=app.config["AVATAR_VERSION"],
+    )
+
+
+@app.route("/avatar/<int:user_id>/<int:size>.<fmt>")
+def avatar(user_id, size, fmt):
+    if size not in app.config["AVATAR_SIZES"] or not supported(fmt):
+        abort(404)
+    response = make_response(get_avatar(user_id, size, fmt))
+    response.mimetype = FORMATS[fmt][1]
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["AVATAR_MAX_AGE"]
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,95 @@
+import pickle
+from app import app, db, login
+from app.fragments import LRUCache
+from app.models import User, expire_user
+
+
+class RedisStore(object):
+    prefix = "roblog:user:"
+
+    def __init__(self, maxsize: int, ttl: float):
+        from redis import Redis
+
+        self.redis = Redis.from_url(app.config["REDIS_URL"])
+        self.ttl = int(ttl)
+
+    def get(self, owner, key):
+        value = self.redis.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, owner, key, value):
+        self.redis.setex(self.prefix + key, self.ttl, pickle.dumps(value))
+
+    def invalidate(self, owner):
+        self.redis.delete(self.prefix + owner)
+
+
+class UserCache(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self, user_id: int):
+        if self.backend is None:
+            return User.query.get(user_id)
+        key = str(user_id)
+        attrs = self.backend.get(key, key)
+        if attrs is None:
+            user = User.query.get(user_id)
+            if user is not None:
+                self.backend.set(key, key, snapshot(user))
+            return user
+        user = User(**attrs)
+        db.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_id: int):
+        if self.backend is not None:
+            self.backend.invalidate(str(user_id))
+
+
+def snapshot(user):
+    return {
+        attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs
+    }
+
+
+STORES = {"memory": LRUCache, "redis": RedisStore, "none": None}
+_cache = None
+
+
+def get_user_cache():
+    global _cache
+    if _cache is None:
+        store = STORES[app.config["USER_CACHE"]]
+        _cache = UserCache(
+            store(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+            if store
+            else None
+        )
+    return _cache
+
+
+@login.user_loader
+def load_user(id: int):
+    return get_user_cache().load(int(id))
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _after_flush(session, flush_context):
+    for obj in session.dirty:
+        if isinstance(obj, User) and session.is_modified(obj):
+            expire_user(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            expire_user(obj.id)
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    for user_id in session.info.pop("expired_users", ()):
+        get_user_cache().invalidate(user_id)
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _after_rollback(session, previous_transaction):
+    session.info.pop("expired_users", None)
@@ -0,0 +1,89 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+from app import app, db
+from app.models import User
+
+
+class MemoryStore(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = {}
+
+    def put(self, user_id: int, seen: datetime):
+        with self.lock:
+            self.pending[user_id] = seen
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+
+class RedisStore(object):
+    key = "roblog:last_seen"
+
+    def __init__(self):
+        from redis import Redis
+
+        self.redis = Redis.from_url(app.config["REDIS_URL"])
+
+    def put(self, user_id: int, seen: datetime):
+        self.redis.hset(self.key, user_id, seen.isoformat())
+
+    def drain(self):
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.key)
+        pipe.delete(self.key)
+        pending, _ = pipe.execute()
+        return {
+            int(user_id): datetime.fromisoformat(seen.decode())
+            for user_id, seen in pending.items()
+        }
+
+
+STORES = {"memory": MemoryStore, "redis": RedisStore}
+
+
+class LastSeenBuffer(object):
+    def __init__(self, store=None):
+        self.store = store or STORES[app.config["LAST_SEEN_BACKEND"]]()
+        self.last_flush = time()
+
+    def touch(self, user):
+        now = datetime.utcnow()
+        granularity = timedelta(minutes=app.config["LAST_SEEN_GRANULARITY"])
+        if user.last_seen is None or now - user.last_seen >= granularity:
+            self.store.put(user.id, now)
+        if time() - self.last_flush >= app.config["LAST_SEEN_FLUSH_INTERVAL"]:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time()
+        pending = self.store.drain()
+        if not pending:
+            return 0
+        buckets = {}
+        for user_id, seen in pending.items():
+            buckets.setdefault(seen.replace(second=0, microsecond=0), []).append(
+                user_id
+            )
+        users = User.__table__
+        with db.engine.begin() as conn:
+            for seen, ids in buckets.items():
+                conn.execute(
+                    users.update().where(users.c.id.in_(ids)).values(last_seen=seen)
+                )
+        return len(pending)
+
+
+_buffer = None
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = LastSeenBuffer()
+        atexit.register(_buffer.flush)
+    return _buffer
@@ -0,0 +1,209 @@
+from collections import Counter
+from threading import Lock
+from time import perf_counter
+from flask import g, request, request_started, has_request_context, Response
+from sqlalchemy.engine import Engine
+from app import app, db
+from app.email import pool
+from app.fragments import get_cache
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = (0.0, None)
+        self.statements = Counter()
+
+    def record(self, statement, elapsed: float):
+        self.queries += 1
+        self.db_time += elapsed
+        self.statements[statement] += 1
+        if elapsed > self.slowest[0]:
+            self.slowest = (elapsed, statement)
+
+
+class Histogram(object):
+    def __init__(self, name: str, help: str, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = Lock()
+        self.series = {}
+
+    def observe(self, endpoint: str, value: float):
+        with self.lock:
+            counts, total = self.series.get(
+                endpoint, ([0] * len(self.buckets), 0.0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.series[endpoint] = (counts, total + value)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self.lock:
+            series = sorted(self.series.items())
+        for endpoint, (counts, total) in series:
+            count = counts[-1]
+            for bound, n in zip(self.buckets, counts):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    '{}_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        self.name, endpoint, le, n
+                    )
+                )
+            lines.append(
+                '{}_sum{{endpoint="{}"}} {}'.format(self.name, endpoint, total)
+            )
+            lines.append(
+                '{}_count{{endpoint="{}"}} {}'.format(self.name, endpoint, count)
+            )
+        return lines
+
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf"))
+QUERIES = (1, 2, 5, 10, 20, 50, 100, float("inf"))
+
+request_duration = Histogram(
+    "roblog_request_duration_seconds", "Time spent handling a request.", SECONDS
+)
+db_duration = Histogram(
+    "roblog_db_duration_seconds", "Time spent in SQL per request.", SECONDS
+)
+db_queries = Histogram(
+    "roblog_db_queries", "SQL statements executed per request.", QUERIES
+)
+HISTOGRAMS = (request_duration, db_duration, db_queries)
+
+
+def sample(name: str, kind: str, help: str, value):
+    return [
+        "# HELP {} {}".format(name, help),
+        "# TYPE {} {}".format(name, kind),
+        "{} {}".format(name, value),
+    ]
+
+
+MAIL_SAMPLES = (
+    ("roblog_mail_queued", "gauge", "Mail waiting in the send queue.", "queued"),
+    ("roblog_mail_sent_total", "counter", "Mail sent by the pool.", "sent"),
+    ("roblog_mail_failed_total", "counter", "Mail that failed to send.", "failed"),
+    ("roblog_mail_dropped_total", "counter", "Mail dropped when full.", "dropped"),
+    (
+        "roblog_mail_last_latency_seconds",
+        "gauge",
+        "Queue-to-send time of the last mail.",
+        "last_latency",
+    ),
+    (
+        "roblog_mail_avg_latency_seconds",
+        "gauge",
+        "Mean queue-to-send time of sent mail.",
+        "avg_latency",
+    ),
+)
+FRAGMENT_SAMPLES = (
+    ("roblog_fragment_cache_hits_total", "counter", "Fragment cache hits.", "hits"),
+    (
+        "roblog_fragment_cache_misses_total",
+        "counter",
+        "Fragment cache misses.",
+        "misses",
+    ),
+    (
+        "roblog_fragment_cache_hit_ratio",
+        "gauge",
+        "Share of fragment lookups served from cache.",
+        "hit_rate",
+    ),
+)
+
+
+def samples(table, stats):
+    lines = []
+    for name, kind, help, key in table:
+        lines.extend(sample(name, kind, help, stats[key]))
+    return lines
+
+
+def current_stats():
+    if has_request_context():
+        return g.get("db_stats")
+    return None
+
+
+@request_started.connect_via(app)
+def _request_started(sender, **extra):
+    g.db_stats = RequestStats()
+
+
+@db.event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault("query_started", []).append(perf_counter())
+
+
+@db.event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is not None and conn.info.get("query_started"):
+        stats.record(statement, perf_counter() - conn.info["query_started"].pop())
+
+
+def squash(statement: str):
+    return " ".join(statement.split())
+
+
+def report(stats, endpoint: str):
+    threshold = app.config["N_PLUS_ONE_THRESHOLD"]
+    for statement, count in stats.statements.most_common():
+        if count < threshold:
+            break
+        app.logger.warning(
+            "Possible N+1 in %s: %d x %s", endpoint, count, squash(statement)
+        )
+    elapsed, statement = stats.slowest
+    if elapsed >= app.config["SLOW_QUERY_THRESHOLD"]:
+        app.logger.warning(
+            "Slow query in %s (%.3fs): %s", endpoint, elapsed, squash(statement)
+        )
+
+
+@app.after_request
+def record_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+    endpoint = request.endpoint or "unmatched"
+    request_duration.observe(endpoint, perf_counter() - stats.started)
+    db_duration.observe(endpoint, stats.db_time)
+    db_queries.observe(endpoint, stats.queries)
+    report(stats, endpoint)
+    if app.debug:
+        response.headers["X-DB-Queries"] = str(stats.queries)
+        response.headers["Server-Timing"] = (
+            'db;dur={:.1f};desc="{} queries", db-slowest;dur={:.1f}, '
+            "app;dur={:.1f}".format(
+                stats.db_time * 1000,
+                stats.queries,
+                stats.slowest[0] * 1000,
+                (perf_counter() - stats.started) * 1000,
+            )
+        )
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.extend(samples(MAIL_SAMPLES, pool.stats()))
+    lines.extend(samples(FRAGMENT_SAMPLES, get_cache().stats()))
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
@@ -1,42 +1,231 @@
 from datetime import datetime
-from app import db, login
+from app import db
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from time import time
+from flask import abort
 from app import app
+from app.search import query_index, enqueue, register_index
+from app.search import reindex as reindex_model
+from app.notify import publish_on_commit
+from app.fragments import invalidate
+from sqlalchemy.orm.attributes import set_committed_value
 import jwt
 import json
 
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_followers_followed_id", "followed_id"),
 )
 
 voted_by = db.Table(
     "voted_by",
-    db.Column("user_id", db.Integer, db.ForeignKey("post.id")),
-    db.Column("post_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("direction", db.SmallInteger, nullable=False, server_default="1"),
+    db.Index("ix_voted_by_post_id", "post_id"),
 )
 
 voted_by_comm = db.Table(
     "voted_by_comm",
-    db.Column("user_id", db.Integer, db.ForeignKey("comments.id")),
-    db.Column("comments_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column(
+        "comments_id", db.Integer, db.ForeignKey("comments.id"), primary_key=True
+    ),
+    db.Column("direction", db.SmallInteger, nullable=False, server_default="1"),
+    db.Index("ix_voted_by_comm_comments_id", "comments_id"),
 )
 
+feed_version = db.Table(
+    "feed_version",
+    db.Column("kind", db.String(16), primary_key=True),
+    db.Column("ref_id", db.Integer, primary_key=True),
+    db.Column("shard", db.SmallInteger, primary_key=True, default=0),
+    db.Column("version", db.Integer, nullable=False, default=0),
+)
+
+VOTE_DIRECTIONS = {"+": 1, "-": -1}
+
 users_in_communities = db.Table(
     "users_in_communities",
-    db.Column("user_id", db.Integer, db.ForeignKey("community.id")),
-    db.Column("community_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column(
+        "community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True
+    ),
+    db.Index("ix_users_in_communities_community_id", "community_id"),
+)
+
+timeline = db.Table(
+    "timeline",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("timestamp", db.DateTime),
+    db.Index("ix_timeline_user_id_timestamp", "user_id", "timestamp"),
 )
 
+def upsert(table, keys, update, changed=()):
+    # Conflicting rows whose `changed` columns already hold the incoming
+    # values are left untouched.
+    dialect = db.engine.dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+
+        stmt = insert(table)
+        # Assignments apply left to right, so the compared columns go last.
+        values = [
+            (c, stmt.inserted[c]) for c in sorted(update, key=lambda c: c in changed)
+        ]
+        if changed:
+            # stmt.inserted would render as VALUES() of the assigned column.
+            same = db.and_(
+                *[
+                    table.c[c].is_not_distinct_from(
+                        db.literal_column("VALUES({})".format(c))
+                    )
+                    for c in changed
+                ]
+            )
+            values = [(c, db.case((same, table.c[c]), else_=v)) for c, v in values]
+        return stmt.on_duplicate_key_update(values)
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={c: stmt.excluded[c] for c in update},
+        where=db.or_(
+            *[table.c[c].is_distinct_from(stmt.excluded[c]) for c in changed]
+        )
+        if changed
+        else None,
+    )
+
+
+def insert_ignore(table):
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        return insert(table).on_conflict_do_nothing()
+    if dialect == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    return table.insert().prefix_with("OR IGNORE")
+
+
+def cast_vote(table, target_column: str, target_id: int, user_id: int, direction: int):
+    result = db.session.execute(
+        insert_ignore(table).values(
+            {"user_id": user_id, target_column: target_id, "direction": direction}
+        )
+    )
+    return result.rowcount == 1
+
+
+def touch(kind: str, ref_id: int):
+    db.session.info.setdefault("touched_versions", set()).add((kind, ref_id))
+
+
+def expire_user(user_id: int):
+    db.session.info.setdefault("expired_users", set()).add(user_id)
+
+
+def rescore(post_id: int):
+    db.session.info.setdefault("rescore_posts", set()).add(post_id)
+
+
+def hot_score(karma: int, timestamp: datetime, now: datetime = None):
+    hours = ((now or datetime.utcnow()) - timestamp).total_seconds() / 3600
+    if hours >= app.config["HOT_HORIZON_HOURS"]:
+        return 0.0
+    return ((karma or 0) + 1) / (max(hours, 0) + 2) ** app.config["HOT_GRAVITY"]
+
+
+def _default_hot(context):
+    params = context.get_current_parameters()
+    return hot_score(params.get("karma"), params.get("timestamp") or datetime.utcnow())
+
+
+def add_karma(model, id: int, delta: int):
+    model.query.filter_by(id=id).update(
+        {model.karma: model.karma + delta}, synchronize_session=False
+    )
+    if model is User:
+        expire_user(id)
+    elif model is Post:
+        rescore(id)
+
+
+class SearchableMixin(object):
+    @classmethod
+    def search(cls, expression: str, page: int, per_page: int):
+        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        if total == 0 or not ids:
+            return cls.query.filter_by(id=0), total
+        when = [(id, i) for i, id in enumerate(ids)]
+        return (
+            cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)),
+            total,
+        )
+
+    def search_payload(self):
+        return {field: getattr(self, field) for field in self.__searchable__}
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        changes = session.info.setdefault("search_changes", {})
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                changes[(obj.__tablename__, obj.id)] = obj.search_payload()
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and any(
+                db.inspect(obj).attrs[field].history.has_changes()
+                for field in obj.__searchable__
+            ):
+                changes[(obj.__tablename__, obj.id)] = obj.search_payload()
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes[(obj.__tablename__, obj.id)] = None
+
+    @classmethod
+    def after_commit(cls, session):
+        changes = session.info.pop("search_changes", None)
+        if not changes:
+            return
+        ops = [
+            ("delete" if payload is None else "index", index, id, payload)
+            for (index, id), payload in changes.items()
+        ]
+        try:
+            enqueue(ops)
+        except Exception:
+            app.logger.exception("Could not queue %d search updates", len(ops))
+
+    @classmethod
+    def after_rollback(cls, session, previous_transaction):
+        session.info.pop("search_changes", None)
+
+    @classmethod
+    def reindex(cls, chunk_size: int = 1000):
+        return reindex_model(cls, chunk_size)
+
+
+db.event.listen(db.session, "after_flush", SearchableMixin.after_flush)
+db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+db.event.listen(db.session, "after_soft_rollback", SearchableMixin.after_rollback)
+
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True, index=True)
     username = db.Column(db.String(32), index=True, unique=True)
     email = db.Column(db.String(64), index=True, unique=True)
     password_hash = db.Column(db.String(128))
-    posts = db.relationship("Post", backref="author", lazy="dynamic")
+    posts = db.relationship(
+        "Post", backref=db.backref("author", lazy="selectin"), lazy="dynamic"
+    )
     about_me = db.Column(db.String(128))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     karma = db.Column(db.Integer, default=0)
@@ -49,7 +238,10 @@ class User(UserMixin, db.Model):
         lazy="dynamic",
     )
     messages_sent = db.relationship(
-        "Message", foreign_keys="Message.sender_id", backref="author", lazy="dynamic"
+        "Message",
+        foreign_keys="Message.sender_id",
+        backref=db.backref("author", lazy="selectin"),
+        lazy="dynamic",
     )
     messages_received = db.relationship(
         "Message",
@@ -58,6 +250,7 @@ class User(UserMixin, db.Model):
         lazy="dynamic",
     )
     last_message_read_time = db.Column(db.DateTime)
+    unread_message_count = db.Column(db.Integer, default=0, server_default="0")
     notifications = db.relationship("Notification", backref="author", lazy="dynamic")
 
     def _repr_(self):
@@ -90,6 +283,18 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own, followedcomms).order_by(Post.timestamp.desc())
 
+    def timeline_posts(self):
+        return (
+            Post.query.join(timeline, timeline.c.post_id == Post.id)
+            .filter(timeline.c.user_id == self.id)
+            .order_by(timeline.c.timestamp.desc())
+        )
+
+    def home_posts(self):
+        if app.config["TIMELINE_ENABLED"]:
+            return self.timeline_posts()
+        return self.followed_posts()
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {"reset_password": self.id, "exp": time() + expires_in},
@@ -108,33 +313,64 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
     def new_messages(self):
+        return self.unread_message_count or 0
+
+    def change_unread(self, delta: int):
+        self.unread_message_count = User.unread_message_count + delta
+        db.session.flush()
+        return self.new_messages()
+
+    def is_unread(self, message):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return (
-            Message.query.filter_by(recipient=self)
-            .filter(Message.timestamp > last_read_time)
-            .count()
+        if message.conversation_id is not None:
+            member = ConversationMember.query.get((self.id, message.conversation_id))
+            if member is not None and member.read_at is not None:
+                last_read_time = max(last_read_time, member.read_at)
+        return message.timestamp > last_read_time
+
+    @staticmethod
+    def recount_unread_messages():
+        last_read_time = db.func.coalesce(
+            User.last_message_read_time, datetime(1900, 1, 1)
+        )
+        read_in_conversation = (
+            db.select(ConversationMember.user_id)
+            .where(ConversationMember.user_id == User.id)
+            .where(ConversationMember.conversation_id == Message.conversation_id)
+            .where(ConversationMember.read_at >= Message.timestamp)
+        )
+        unread = (
+            db.select(db.func.count(Message.id))
+            .where(Message.recipient_id == User.id)
+            .where(Message.timestamp > last_read_time)
+            .where(~read_in_conversation.exists())
+            .scalar_subquery()
+        )
+        return User.query.update(
+            {User.unread_message_count: unread}, synchronize_session=False
         )
 
     def add_notification(self, name: str, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user_id=self.id)
-        db.session.add(n)
-        return n
-
+        event = {"name": name, "data": data, "timestamp": time()}
+        pending = db.session.info.setdefault("pending_notifications", {})
+        pending[(self.id, name)] = event
+        return event
 
-@login.user_loader
-def load_user(id: int):
-    return User.query.get(int(id))
 
-
-class Post(db.Model):
+class Post(SearchableMixin, db.Model):
     __searchable__ = ["body"]
+    __table_args__ = (
+        db.Index("ix_post_communityid_hot", "communityid", "hot", "id"),
+        db.Index("ix_post_communityid_timestamp", "communityid", "timestamp", "karma"),
+    )
     id = db.Column(db.Integer, primary_key=True, index=True)
     communityid = db.Column(db.Integer, db.ForeignKey('community.id'), default=None)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     karma = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0, server_default="0")
+    hot = db.Column(db.Float, default=_default_hot, server_default="0")
     voted_on = db.relationship(
         "User",
         secondary=voted_by,
@@ -144,6 +380,7 @@ class Post(db.Model):
         lazy="dynamic",
     )
     comments = db.relationship("Comment", backref="post", lazy="dynamic")
+    community = db.relationship("Community", back_populates="posts", lazy="selectin")
 
     def __repr__(self):
         return "<Post {}>".format(self.body)
@@ -152,28 +389,54 @@ class Post(db.Model):
         return self.voted_on.filter(voted_by.c.user_id == user.id).count() > 0
 
     def karmachange(self, user: User, change: str, postauthor: User):
-        if not self.is_voted(user):
-            self.voted_on.append(user)
-            if change == "+":
-                self.karma = self.karma + 1
-                postauthor.karma = postauthor.karma + 1
-                db.session.commit()
-                return True
-            elif change == "-":
-                self.karma = self.karma - 1
-                postauthor.karma = postauthor.karma - 1
-                db.session.commit()
-                return True
-        return False
+        direction = VOTE_DIRECTIONS.get(change)
+        if direction is None:
+            return False
+        if not cast_vote(voted_by, "post_id", self.id, user.id, direction):
+            return False
+        add_karma(Post, self.id, direction)
+        add_karma(User, postauthor.id, direction)
+        self.touch()
+        db.session.commit()
+        invalidate("post", self.id)
+        return True
+
+    def touch(self):
+        touch("user", self.user_id)
+        if self.communityid is None:
+            touch("explore", 0)
+        else:
+            touch("community", self.communityid)
+
+    def change_comment_count(self, delta: int):
+        self.comment_count = Post.comment_count + delta
+
+    @staticmethod
+    def recount_comments():
+        comments = (
+            db.select(db.func.count(Comment.id))
+            .where(Comment.post_id == Post.id)
+            .scalar_subquery()
+        )
+        return Post.query.update(
+            {Post.comment_count: comments}, synchronize_session=False
+        )
 
     def getcommname(self):
-        community = Community.query.filter_by(id = self.communityid).first_or_404()
-        return community.name
+        if self.community is None:
+            abort(404)
+        return self.community.name
 
 class Message(db.Model):
+    __table_args__ = (
+        db.Index(
+            "ix_message_conversation_id_timestamp", "conversation_id", "timestamp", "id"
+        ),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    conversation_id = db.Column(db.Integer, db.ForeignKey("conversation.id"))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     karma = None
@@ -182,7 +445,213 @@ class Message(db.Model):
         return "<Message {}>".format(self.body)
 
 
+class Conversation(db.Model):
+    __table_args__ = (db.UniqueConstraint("user_a_id", "user_b_id"),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_a_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    last_message_id = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime)
+    last_message = db.relationship(
+        "Message",
+        primaryjoin="foreign(Conversation.last_message_id) == Message.id",
+        lazy="joined",
+    )
+
+    @staticmethod
+    def between(user_id: int, peer_id: int, create: bool = False):
+        a, b = sorted((user_id, peer_id))
+        if create:
+            db.session.execute(
+                insert_ignore(Conversation.__table__).values(user_a_id=a, user_b_id=b)
+            )
+        conversation = Conversation.query.filter_by(user_a_id=a, user_b_id=b).first()
+        if create:
+            members = ConversationMember.__table__
+            for user, peer in ((a, b), (b, a)):
+                db.session.execute(
+                    insert_ignore(members).values(
+                        user_id=user, peer_id=peer, conversation_id=conversation.id
+                    )
+                )
+        return conversation
+
+    @staticmethod
+    def deliver(message):
+        recipient_id = message.recipient.id
+        conversation = Conversation.between(
+            message.author.id, recipient_id, create=True
+        )
+        message.conversation_id = conversation.id
+        db.session.flush()
+        conversation.last_message_id = message.id
+        conversation.timestamp = message.timestamp
+        member = ConversationMember
+        received = db.case((member.user_id == recipient_id, 1), else_=0)
+        member.query.filter_by(conversation_id=conversation.id).update(
+            {
+                member.timestamp: message.timestamp,
+                member.unread_count: member.unread_count + received,
+            },
+            synchronize_session=False,
+        )
+        return conversation
+
+    @staticmethod
+    def retract(message):
+        recipient = message.recipient
+        unread = recipient.is_unread(message)
+        conversation = None
+        if message.conversation_id is not None:
+            conversation = Conversation.query.get(message.conversation_id)
+        db.session.delete(message)
+        db.session.flush()
+        if unread:
+            recipient.change_unread(-1)
+        if conversation is None:
+            return
+        members = ConversationMember.query.filter_by(conversation_id=conversation.id)
+        if unread:
+            members.filter_by(user_id=recipient.id).update(
+                {ConversationMember.unread_count: ConversationMember.unread_count - 1},
+                synchronize_session=False,
+            )
+        last = (
+            Message.query.filter_by(conversation_id=conversation.id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .first()
+        )
+        if last is None:
+            members.delete(synchronize_session=False)
+            db.session.delete(conversation)
+            return
+        conversation.last_message_id = last.id
+        conversation.timestamp = last.timestamp
+        members.update(
+            {ConversationMember.timestamp: last.timestamp}, synchronize_session=False
+        )
+
+    @staticmethod
+    def rebuild():
+        messages, conversations = Message.__table__, Conversation.__table__
+        members, users = ConversationMember.__table__, User.__table__
+        sender, recipient = messages.c.sender_id, messages.c.recipient_id
+        low = db.case((sender < recipient, sender), else_=recipient)
+        high = db.case((sender < recipient, recipient), else_=sender)
+        db.session.execute(
+            insert_ignore(conversations).from_select(
+                ["user_a_id", "user_b_id"],
+                db.select(low, high)
+                .where(messages.c.conversation_id == None)
+                .distinct(),
+            )
+        )
+        db.session.execute(
+            messages.update()
+            .where(messages.c.conversation_id == None)
+            .values(
+                conversation_id=db.select(conversations.c.id)
+                .where(conversations.c.user_a_id == low)
+                .where(conversations.c.user_b_id == high)
+                .scalar_subquery()
+            )
+        )
+        last = (
+            db.select(messages.c.id)
+            .where(messages.c.conversation_id == conversations.c.id)
+            .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        db.session.execute(conversations.update().values(last_message_id=last))
+        db.session.execute(
+            conversations.update().values(
+                timestamp=db.select(messages.c.timestamp)
+                .where(messages.c.id == conversations.c.last_message_id)
+                .scalar_subquery()
+            )
+        )
+        empty = db.select(conversations.c.id).where(
+            conversations.c.last_message_id == None
+        )
+        db.session.execute(members.delete().where(members.c.conversation_id.in_(empty)))
+        db.session.execute(
+            conversations.delete().where(conversations.c.last_message_id == None)
+        )
+        for user, peer in (
+            (conversations.c.user_a_id, conversations.c.user_b_id),
+            (conversations.c.user_b_id, conversations.c.user_a_id),
+        ):
+            db.session.execute(
+                insert_ignore(members).from_select(
+                    ["user_id", "peer_id", "conversation_id"],
+                    db.select(user, peer, conversations.c.id),
+                )
+            )
+        never = datetime(1900, 1, 1)
+        read_at = db.func.coalesce(members.c.read_at, never)
+        last_read_time = db.func.coalesce(
+            db.select(users.c.last_message_read_time)
+            .where(users.c.id == members.c.user_id)
+            .scalar_subquery(),
+            never,
+        )
+        unread = (
+            db.select(db.func.count(messages.c.id))
+            .where(messages.c.conversation_id == members.c.conversation_id)
+            .where(messages.c.recipient_id == members.c.user_id)
+            .where(messages.c.timestamp > read_at)
+            .where(messages.c.timestamp > last_read_time)
+            .scalar_subquery()
+        )
+        timestamp = (
+            db.select(conversations.c.timestamp)
+            .where(conversations.c.id == members.c.conversation_id)
+            .scalar_subquery()
+        )
+        return db.session.execute(
+            members.update().values(unread_count=unread, timestamp=timestamp)
+        ).rowcount
+
+
+class ConversationMember(db.Model):
+    __tablename__ = "conversation_member"
+    __table_args__ = (
+        db.Index(
+            "ix_conversation_member_user_id_timestamp",
+            "user_id",
+            "timestamp",
+            "conversation_id",
+        ),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    conversation_id = db.Column(
+        db.Integer, db.ForeignKey("conversation.id"), primary_key=True
+    )
+    peer_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    timestamp = db.Column(db.DateTime)
+    read_at = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, default=0, server_default="0")
+    conversation = db.relationship("Conversation", lazy="joined", innerjoin=True)
+    peer = db.relationship(
+        "User", foreign_keys=[peer_id], lazy="joined", innerjoin=True
+    )
+
+    def mark_read(self, user: User):
+        unread = self.unread_count or 0
+        if not unread:
+            return 0
+        self.read_at = datetime.utcnow()
+        self.unread_count = 0
+        user.add_notification("unread_message_count", user.change_unread(-unread))
+        return unread
+
+
 class Notification(db.Model):
+    __table_args__ = (
+        db.Index("uq_notification_user_id_name", "user_id", "name", unique=True),
+        db.Index("ix_notification_user_id_timestamp", "user_id", "timestamp"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
@@ -192,16 +661,93 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_event(self):
+        return {"name": self.name, "data": self.get_data(), "timestamp": self.timestamp}
+
+    @staticmethod
+    def compact(batch_size: int = None, now: float = None):
+        batch_size = batch_size or app.config["NOTIFICATION_COMPACT_BATCH_SIZE"]
+        cutoff = (now or time()) - app.config["NOTIFICATION_TTL"]
+        deleted = 0
+        while True:
+            ids = [
+                id
+                for (id,) in db.session.query(Notification.id)
+                .filter(Notification.timestamp < cutoff)
+                .limit(batch_size)
+            ]
+            if not ids:
+                return deleted
+            Notification.query.filter(Notification.id.in_(ids)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+            deleted += len(ids)
+
+
+# Repeats within a transaction collapse in session.info; a repeat of the
+# value already stored leaves the row and its timestamp as they are.
+@db.event.listens_for(db.session, "before_commit")
+def _write_notifications(session):
+    pending = session.info.pop("pending_notifications", None)
+    if not pending:
+        return
+    rows = []
+    for (user_id, name), event in pending.items():
+        rows.append(
+            {
+                "user_id": user_id,
+                "name": name,
+                "payload_json": json.dumps(event["data"]),
+                "timestamp": event["timestamp"],
+            }
+        )
+        publish_on_commit(user_id, event)
+    session.execute(
+        upsert(
+            Notification.__table__,
+            ["user_id", "name"],
+            ["payload_json", "timestamp"],
+            changed=["payload_json"],
+        ),
+        rows,
+    )
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _discard_notifications(session, previous_transaction):
+    session.info.pop("pending_notifications", None)
+
+
+def comment_path(parent_path, id: int):
+    segment = "{:010d}".format(id)
+    return parent_path + "." + segment if parent_path else segment
+
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (
+        db.Index(
+            "ix_comments_post_id_root_id_path", "post_id", "root_id", "path", "depth"
+        ),
+        db.Index(
+            "ix_comments_post_id_depth_timestamp", "post_id", "depth", "timestamp", "id"
+        ),
+    )
     id = db.Column(db.Integer, primary_key=True, index=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    post_id = db.Column(db.Integer, db.ForeignKey("post.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), index=True)
     karma = db.Column(db.Integer, default=0)
+    parent_id = db.Column(db.Integer, db.ForeignKey("comments.id"))
+    root_id = db.Column(db.Integer)
+    path = db.Column(db.String(255))
+    depth = db.Column(db.Integer, default=0, server_default="0")
+    descendant_count = db.Column(db.Integer, default=0, server_default="0")
+    reply_count = db.Column(db.Integer, default=0, server_default="0")
+    author = db.relationship("User", lazy="selectin")
     voted_on_comm = db.relationship(
         "User",
         secondary=voted_by_comm,
@@ -215,33 +761,123 @@ class Comment(db.Model):
         return "<Post {}>".format(self.body)
 
     def username(self):
-        username = User.query.filter_by(id=self.author_id).first_or_404()
-        return username.username
+        if self.author is None:
+            abort(404)
+        return self.author.username
+
+    def ancestor_ids(self):
+        return [int(segment) for segment in self.path.split(".")[:-1]]
+
+    def place(self, parent=None):
+        if parent is not None and parent.depth >= app.config["COMMENT_MAX_DEPTH"]:
+            parent = Comment.query.get(parent.parent_id)
+        if self.id is None:
+            db.session.flush()
+        self.parent_id = parent.id if parent else None
+        self.root_id = parent.root_id if parent else self.id
+        self.depth = parent.depth + 1 if parent else 0
+        self.path = comment_path(parent.path if parent else None, self.id)
+        ancestors = self.ancestor_ids()
+        if ancestors:
+            Comment.query.filter(Comment.id.in_(ancestors)).update(
+                {
+                    Comment.descendant_count: Comment.descendant_count + 1,
+                    Comment.reply_count: Comment.reply_count
+                    + db.case((Comment.id == self.parent_id, 1), else_=0),
+                },
+                synchronize_session=False,
+            )
+
+    def subtree(self):
+        return Comment.query.filter(
+            Comment.post_id == self.post_id,
+            Comment.root_id == self.root_id,
+            Comment.path >= self.path,
+            Comment.path < self.path + "/",
+        )
+
+    def remove(self):
+        ids = [id for (id,) in self.subtree().with_entities(Comment.id)]
+        ancestors = self.ancestor_ids()
+        if ancestors:
+            Comment.query.filter(Comment.id.in_(ancestors)).update(
+                {
+                    Comment.descendant_count: Comment.descendant_count - len(ids),
+                    Comment.reply_count: Comment.reply_count
+                    - db.case((Comment.id == self.parent_id, 1), else_=0),
+                },
+                synchronize_session=False,
+            )
+        subtree_ids = self.subtree().with_entities(Comment.id).subquery()
+        db.session.execute(
+            voted_by_comm.delete().where(
+                voted_by_comm.c.comments_id.in_(db.select(subtree_ids.c.id))
+            )
+        )
+        self.subtree().delete(synchronize_session=False)
+        db.session.expunge(self)
+        return ids
+
+    @staticmethod
+    def threads(post_id: int, root_ids, replies: int, depth: int):
+        if not root_ids:
+            return []
+        # One index range scan per thread, stopping after the first replies.
+        heads = [
+            db.select(
+                db.select(Comment.id)
+                .where(Comment.post_id == post_id)
+                .where(Comment.root_id == root_id)
+                .where(Comment.depth <= depth)
+                .order_by(Comment.path)
+                .limit(replies + 1)
+                .subquery()
+            )
+            for root_id in root_ids
+        ]
+        return (
+            Comment.query.filter(Comment.id.in_(db.union_all(*heads)))
+            .order_by(Comment.path)
+            .all()
+        )
 
     def is_voted_on(self, user: User):
         return self.voted_on_comm.filter(voted_by_comm.c.user_id == user.id).count() > 0
 
     def karmachangecomm(self, user: User, change: str, commauthor: User):
-        if not self.is_voted_on(user):
-            self.voted_on_comm.append(user)
-            if change == "+":
-                self.karma = self.karma + 1
-                commauthor.karma = commauthor.karma + 1
-                db.session.commit()
-                return True
-            elif change == "-":
-                self.karma = self.karma - 1
-                commauthor.karma = commauthor.karma - 1
-                db.session.commit()
-                return True
-        return False
+        direction = VOTE_DIRECTIONS.get(change)
+        if direction is None:
+            return False
+        if not cast_vote(voted_by_comm, "comments_id", self.id, user.id, direction):
+            return False
+        add_karma(Comment, self.id, direction)
+        add_karma(User, commauthor.id, direction)
+        touch("user", commauthor.id)
+        db.session.commit()
+        invalidate("comment", self.id)
+        return True
+
+
+@db.event.listens_for(Comment, "after_insert")
+def _place_root(mapper, connection, target):
+    if target.path is not None:
+        return
+    path = comment_path(None, target.id)
+    connection.execute(
+        Comment.__table__.update()
+        .where(Comment.__table__.c.id == target.id)
+        .values(root_id=target.id, path=path)
+    )
+    set_committed_value(target, "root_id", target.id)
+    set_committed_value(target, "path", path)
+
 
 class Community(db.Model):
     __tablename__ = "community"
     id = db.Column(db.Integer, primary_key=True, index=True)
     name = db.Column(db.String(32), index=True, unique=True)
     about = db.Column(db.String(164))
-    posts = db.relationship("Post")
+    posts = db.relationship("Post", back_populates="community")
     users_in_communities = db.relationship(
         "User",
         secondary=users_in_communities ,
@@ -260,4 +896,15 @@ class Community(db.Model):
             self.users_in_communities.remove(user)
 
     def is_followingcomm(self, user):
-        return self.users_in_communities.filter(users_in_communities.c.user_id == user.id).count() > 0
\ No newline at end of file
+        return self.users_in_communities.filter(users_in_communities.c.user_id == user.id).count() > 0
+
+
+Community.member_count = db.column_property(
+    db.select(db.func.count(users_in_communities.c.user_id))
+    .where(users_in_communities.c.community_id == Community.id)
+    .correlate_except(users_in_communities)
+    .scalar_subquery(),
+    deferred=True,
+)
+
+register_index(Post)
@@ -0,0 +1,125 @@
+import json
+from queue import Queue, Empty
+from threading import Lock
+from time import time
+from app import app, db
+
+
+class MemorySubscription(object):
+    def __init__(self, broker, user_id: int):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = Queue()
+
+    def get(self, timeout: float):
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class MemoryBroker(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.channels = {}
+
+    def subscribe(self, user_id: int):
+        subscription = MemorySubscription(self, user_id)
+        with self.lock:
+            self.channels.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            channel = self.channels.get(subscription.user_id, set())
+            channel.discard(subscription)
+            if not channel:
+                self.channels.pop(subscription.user_id, None)
+
+    def publish(self, user_id: int, event):
+        with self.lock:
+            subscriptions = list(self.channels.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.queue.put(event)
+
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout: float):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        return json.loads(message["data"])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker(object):
+    prefix = "roblog:notifications:"
+
+    def __init__(self):
+        from redis import Redis
+
+        self.redis = Redis.from_url(app.config["REDIS_URL"])
+
+    def subscribe(self, user_id: int):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.prefix + str(user_id))
+        return RedisSubscription(pubsub)
+
+    def publish(self, user_id: int, event):
+        self.redis.publish(self.prefix + str(user_id), json.dumps(event))
+
+
+BROKERS = {"memory": MemoryBroker, "redis": RedisBroker}
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = BROKERS[app.config["NOTIFICATION_BROKER"]]()
+    return _broker
+
+
+def publish_on_commit(user_id: int, event):
+    db.session.info.setdefault("notifications", []).append((user_id, event))
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    for user_id, event in session.info.pop("notifications", []):
+        try:
+            get_broker().publish(user_id, event)
+        except Exception:
+            app.logger.exception("Could not publish notification to %s", user_id)
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _after_rollback(session, previous_transaction):
+    session.info.pop("notifications", None)
+
+
+def format_event(event):
+    return "id: {}\ndata: {}\n\n".format(event["timestamp"], json.dumps(event))
+
+
+def stream(user_id: int, backlog):
+    subscription = get_broker().subscribe(user_id)
+    heartbeat = app.config["NOTIFICATION_HEARTBEAT"]
+    deadline = time() + app.config["NOTIFICATION_STREAM_TIMEOUT"]
+    try:
+        yield "retry: 3000\n\n"
+        for event in backlog:
+            yield format_event(event)
+        while time() < deadline:
+            event = subscription.get(timeout=min(heartbeat, deadline - time()))
+            yield ": keepalive\n\n" if event is None else format_event(event)
+    finally:
+        subscription.close()
@@ -0,0 +1,98 @@
+import base64
+import json
+from datetime import datetime
+from flask import request, abort
+from sqlalchemy import and_, or_
+from app import app, db
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(direction: str, values):
+    raw = json.dumps(
+        [direction]
+        + [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, *values = json.loads(raw)
+        if direction not in ("next", "prev") or len(values) != len(columns):
+            raise ValueError(cursor)
+        return direction, [
+            datetime.fromisoformat(v) if isinstance(c.type, db.DateTime) else v
+            for c, v in zip(columns, values)
+        ]
+    except (ValueError, TypeError):
+        abort(400)
+
+
+def _beyond(columns, values, older: bool):
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(
+            and_(*equal, column < values[i] if older else column > values[i])
+        )
+    return or_(*clauses)
+
+
+def keyset_paginate(query, columns, key=None, per_page=None, descending=True):
+    per_page = per_page or app.config["POSTS_PER_PAGE"]
+    if key is None:
+        key = lambda item: tuple(getattr(item, c.key) for c in columns)
+    query = query.order_by(None)
+    forward = [c.desc() if descending else c.asc() for c in columns]
+    backward = [c.asc() if descending else c.desc() for c in columns]
+    cursor = request.args.get("cursor")
+    if cursor:
+        direction, values = decode_cursor(cursor, columns)
+    else:
+        direction, values = "next", None
+
+    if direction == "prev":
+        items = (
+            query.filter(_beyond(columns, values, older=not descending))
+            .order_by(*backward)
+            .limit(per_page + 1)
+            .all()
+        )
+        more = len(items) > per_page
+        items = items[:per_page][::-1]
+        has_prev, has_next = more, True
+    else:
+        ordered = query.order_by(*forward)
+        if values is not None:
+            window = ordered.filter(_beyond(columns, values, older=descending))
+            has_prev = True
+        else:
+            page = max(request.args.get("page", 1, type=int), 1)
+            window = ordered.offset((page - 1) * per_page)
+            has_prev = page > 1
+        items = window.limit(per_page + 1).all()
+        has_next = len(items) > per_page
+        items = items[:per_page]
+
+    if not items:
+        return KeysetPage(items)
+    return KeysetPage(
+        items,
+        next_cursor=encode_cursor("next", key(items[-1])) if has_next else None,
+        prev_cursor=encode_cursor("prev", key(items[0])) if has_prev else None,
+    )
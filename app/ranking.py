@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+from flask import request
+from app import app, db
+from app.models import Post, hot_score, touch
+
+
+SORTS = ("new", "hot", "top")
+TOP_WINDOWS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+EPOCH = datetime(1970, 1, 1)
+
+
+# Floored to TOP_WINDOW_STEP so a top listing, and the ETag covering it, only
+# change when the window has moved by a whole step.
+def window_start(window: str, now: datetime = None):
+    since = (now or datetime.utcnow()) - TOP_WINDOWS[window]
+    seconds = (since - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=seconds - seconds % app.config["TOP_WINDOW_STEP"])
+
+
+def ranked(query, sort: str, window: str):
+    if sort == "hot":
+        return query, (Post.hot, Post.id)
+    if sort == "top":
+        since = window_start(window)
+        return query.filter(Post.timestamp >= since), (Post.karma, Post.id)
+    return query, (Post.timestamp, Post.id)
+
+
+def sort_args():
+    sort = request.args.get("sort")
+    window = request.args.get("window")
+    return (
+        sort if sort in SORTS else SORTS[0],
+        window if window in TOP_WINDOWS else "day",
+    )
+
+
+def window_token():
+    sort, window = sort_args()
+    return window_start(window) if sort == "top" else None
+
+
+def feed_args(sort: str, window: str):
+    if sort == "top":
+        return {"sort": sort, "window": window}
+    return {"sort": sort} if sort != SORTS[0] else {}
+
+
+def store_scores(session, scores):
+    if not scores:
+        return
+    table = Post.__table__
+    session.execute(
+        table.update()
+        .where(table.c.id == db.bindparam("target"))
+        .values(hot=db.bindparam("score")),
+        [{"target": id, "score": score} for id, score in scores],
+    )
+
+
+def touch_feeds(community_ids):
+    for community_id in community_ids:
+        if community_id is None:
+            touch("explore", 0)
+        else:
+            touch("community", community_id)
+
+
+@db.event.listens_for(db.session, "before_commit")
+def _before_commit(session):
+    ids = session.info.pop("rescore_posts", None)
+    if not ids:
+        return
+    now = datetime.utcnow()
+    rows = session.query(Post.id, Post.karma, Post.timestamp).filter(
+        Post.id.in_(ids)
+    )
+    store_scores(session, [(id, hot_score(k, ts, now)) for id, k, ts in rows])
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _after_rollback(session, previous_transaction):
+    session.info.pop("rescore_posts", None)
+
+
+def decay(batch_size: int = None, now: datetime = None):
+    batch_size = batch_size or app.config["HOT_BATCH_SIZE"]
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(hours=app.config["HOT_HORIZON_HOURS"])
+    aged = Post.query.filter(Post.timestamp < cutoff, Post.hot != 0)
+    touch_feeds({cid for (cid,) in aged.with_entities(Post.communityid).distinct()})
+    expired = aged.update({Post.hot: 0.0}, synchronize_session=False)
+    db.session.commit()
+    live, last = 0, None
+    while True:
+        query = db.session.query(
+            Post.id, Post.karma, Post.timestamp, Post.communityid
+        ).filter(Post.timestamp >= cutoff)
+        if last is not None:
+            query = query.filter(db.tuple_(Post.timestamp, Post.id) > last)
+        rows = query.order_by(Post.timestamp, Post.id).limit(batch_size).all()
+        if not rows:
+            break
+        scores = [(row.id, hot_score(row.karma, row.timestamp, now)) for row in rows]
+        store_scores(db.session, scores)
+        touch_feeds({row.communityid for row in rows})
+        db.session.commit()
+        live += len(rows)
+        last = (rows[-1].timestamp, rows[-1].id)
+    return live, expired
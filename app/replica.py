@@ -0,0 +1,43 @@
+from time import time
+from flask import request, session, request_started, has_request_context
+from app import app, db
+
+
+def use_replica(f):
+    f.use_replica = True
+    return f
+
+
+@request_started.connect_via(app)
+def _route_reads(sender, **extra):
+    view = app.view_functions.get(request.endpoint)
+    if (
+        app.config["SQLALCHEMY_REPLICA_BINDS"]
+        and request.method in ("GET", "HEAD")
+        and getattr(view, "use_replica", False)
+        and session.get("primary_until", 0) < time()
+    ):
+        db.session.info["replica"] = True
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _after_flush(session_, flush_context):
+    session_.info["wrote"] = True
+
+
+@db.event.listens_for(db.session, "do_orm_execute")
+def _on_execute(state):
+    if not state.is_select:
+        state.session.info["wrote"] = True
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _after_commit(session_):
+    wrote = session_.info.pop("wrote", False)
+    if wrote and has_request_context() and app.config["SQLALCHEMY_REPLICA_BINDS"]:
+        session["primary_until"] = time() + app.config["REPLICA_STICKY_SECONDS"]
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _after_rollback(session_, previous_transaction):
+    session_.info.pop("wrote", None)
@@ -1,6 +1,18 @@
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, jsonify
+from flask import (
+    render_template,
+    flash,
+    redirect,
+    url_for,
+    request,
+    jsonify,
+    g,
+    Response,
+    abort,
+    stream_with_context,
+)
 from werkzeug.urls import url_parse
+from sqlalchemy.orm import undefer
 from app import app, db
 from app.forms import (
     LoginForm,
@@ -12,31 +24,54 @@ from app.forms import (
     ResetPasswordRequestForm,
     MessageForm,
     CommentForm,
-    CommunityForm
+    CommunityForm,
+    SearchForm,
 )
 from app.email import send_password_reset_email
+from app.pagination import keyset_paginate
+from app.last_seen import get_buffer
+from app.notify import stream
+from app.fragments import invalidate
+from app.conditional import conditional, version, home_version, user_version
+from app.replica import use_replica
+from app.ranking import ranked, sort_args, feed_args, window_token
+from app.export import export as export_records
 from flask_login import current_user, login_user, logout_user, login_required
-from app.models import User, Post, Message, Notification, Comment, Community
+from app.models import (
+    User,
+    Post,
+    Message,
+    Conversation,
+    ConversationMember,
+    Notification,
+    Comment,
+    Community,
+    timeline,
+)
 
 
 @app.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        get_buffer().touch(current_user)
+        g.search_form = SearchForm()
 
 
 @app.route("/", methods=["GET", "POST"])
 @app.route("/index", methods=["GET", "POST"])
 @login_required
+@conditional(lambda: home_version(current_user.id))
 def index():
     form = PostForm()
-    page = request.args.get("page", 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, app.config["POSTS_PER_PAGE"], False
+    if app.config["TIMELINE_ENABLED"]:
+        keys = (timeline.c.timestamp, timeline.c.post_id)
+    else:
+        keys = (Post.timestamp, Post.id)
+    posts = keyset_paginate(
+        current_user.home_posts(), keys, key=lambda p: (p.timestamp, p.id)
     )
-    next_url = url_for("index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("index", page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for("index", cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for("index", cursor=posts.prev_cursor) if posts.has_prev else None
     if form.validate_on_submit():
         post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
@@ -93,19 +128,18 @@ def register():
 
 @app.route("/user/<username>")
 @login_required
+@use_replica
+@conditional(user_version)
 def user(username: str):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, app.config["POSTS_PER_PAGE"], False
-    )
+    posts = keyset_paginate(user.posts, (Post.timestamp, Post.id))
     next_url = (
-        url_for("user", username=user.username, page=posts.next_num)
+        url_for("user", username=user.username, cursor=posts.next_cursor)
         if posts.has_next
         else None
     )
     prev_url = (
-        url_for("user", username=user.username, page=posts.prev_num)
+        url_for("user", username=user.username, cursor=posts.prev_cursor)
         if posts.has_prev
         else None
     )
@@ -178,21 +212,58 @@ def unfollow(username: str):
 
 @app.route("/explore")
 @login_required
+@use_replica
+@conditional(lambda: (version("explore", 0), window_token()))
 def explore():
     community = Community.query.filter(Community.id == None)
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.filter(Post.communityid == None).order_by(Post.timestamp.desc()).paginate(
-        page, app.config["POSTS_PER_PAGE"], False
+    sort, window = sort_args()
+    args = feed_args(sort, window)
+    posts = keyset_paginate(
+        *ranked(Post.query.filter(Post.communityid == None), sort, window)
+    )
+    next_url = (
+        url_for("explore", cursor=posts.next_cursor, **args) if posts.has_next else None
+    )
+    prev_url = (
+        url_for("explore", cursor=posts.prev_cursor, **args) if posts.has_prev else None
     )
-    next_url = url_for("explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("explore", page=posts.prev_num) if posts.has_prev else None
     return render_template(
         "index.html",
         title="Explore",
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
-        community=community
+        community=community,
+        sort=sort,
+        window=window,
+        sort_endpoint="explore",
+        sort_kwargs={},
+    )
+
+
+@app.route("/search")
+@login_required
+@use_replica
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for("explore"))
+    page = request.args.get("page", 1, type=int)
+    per_page = app.config["POSTS_PER_PAGE"]
+    posts, total = Post.search(g.search_form.q.data, page, per_page)
+    next_url = (
+        url_for("search", q=g.search_form.q.data, page=page + 1)
+        if total > page * per_page
+        else None
+    )
+    prev_url = (
+        url_for("search", q=g.search_form.q.data, page=page - 1) if page > 1 else None
+    )
+    return render_template(
+        "search.html",
+        title="Search",
+        posts=posts.all(),
+        next_url=next_url,
+        prev_url=prev_url,
     )
 
 
@@ -236,7 +307,8 @@ def send_message(recipient: str):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        user.add_notification("unread_message_count", user.new_messages())
+        Conversation.deliver(msg)
+        user.add_notification("unread_message_count", user.change_unread(1))
         db.session.commit()
         flash("Your message has been sent.")
         return redirect(url_for("user", username=recipient))
@@ -249,9 +321,12 @@ def send_message(recipient: str):
 @login_required
 def delete_message(post_id: int):
     post = Message.query.filter_by(id=post_id).first_or_404()
-    db.session.delete(post)
+    sender = post.author
+    Conversation.retract(post)
     db.session.commit()
-    return redirect(url_for("messages"))
+    if Conversation.between(current_user.id, sender.id) is None:
+        return redirect(url_for("messages"))
+    return redirect(url_for("conversation", username=sender.username))
 
 
 @app.route("/deletepost/<post_id>", methods=["GET", "POST"])
@@ -261,6 +336,7 @@ def delete_post(post_id: int):
     post = Post.query.filter_by(id=post_id).first_or_404()
     db.session.delete(post)
     db.session.commit()
+    invalidate("post", post.id)
     return redirect(back)
 
 
@@ -269,49 +345,133 @@ def delete_post(post_id: int):
 def delete_comm(post_id: int):
     back = request.referrer
     post = Comment.query.filter_by(id=post_id).first_or_404()
-    db.session.delete(post)
+    parent = post.post
+    ids = post.remove()
+    if parent is not None:
+        parent.change_comment_count(-len(ids))
     db.session.commit()
+    if parent is not None:
+        invalidate("post", parent.id)
+    for id in ids:
+        invalidate("comment", id)
     return redirect(back)
 
 
 @app.route("/messages")
 @login_required
+@use_replica
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification("unread_message_count", 0)
-    db.session.commit()
-    page = request.args.get("page", 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()
-    ).paginate(page, app.config["POSTS_PER_PAGE"], False)
+    conversations = keyset_paginate(
+        ConversationMember.query.filter_by(user_id=current_user.id),
+        (ConversationMember.timestamp, ConversationMember.conversation_id),
+    )
     next_url = (
-        url_for("messages", page=messages.next_num) if messages.has_next else None
+        url_for("messages", cursor=conversations.next_cursor)
+        if conversations.has_next
+        else None
     )
     prev_url = (
-        url_for("messages", page=messages.prev_num) if messages.has_prev else None
+        url_for("messages", cursor=conversations.prev_cursor)
+        if conversations.has_prev
+        else None
     )
     return render_template(
-        "messages.html", messages=messages.items, next_url=next_url, prev_url=prev_url
+        "messages.html",
+        conversations=conversations.items,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
+@app.route("/messages/<username>")
+@login_required
+def conversation(username: str):
+    peer = User.query.filter_by(username=username).first_or_404()
+    conversation = Conversation.between(current_user.id, peer.id)
+    if conversation is None:
+        return redirect(url_for("send_message", recipient=username))
+    member = ConversationMember.query.get_or_404((current_user.id, conversation.id))
+    if member.mark_read(current_user):
+        db.session.commit()
+    messages = keyset_paginate(
+        Message.query.filter_by(conversation_id=conversation.id),
+        (Message.timestamp, Message.id),
+    )
+    next_url = (
+        url_for("conversation", username=username, cursor=messages.next_cursor)
+        if messages.has_next
+        else None
+    )
+    prev_url = (
+        url_for("conversation", username=username, cursor=messages.prev_cursor)
+        if messages.has_prev
+        else None
+    )
+    return render_template(
+        "conversation.html",
+        title=username,
+        peer=peer,
+        messages=messages.items,
+        next_url=next_url,
+        prev_url=prev_url,
     )
 
 
 @app.route("/notifications")
 @login_required
+@use_replica
 def notifications():
     since = request.args.get("since", 0.0, type=float)
     notifications = current_user.notifications.filter(
         Notification.timestamp > since
     ).order_by(Notification.timestamp.asc())
-    return jsonify(
-        [
-            {"name": n.name, "data": n.get_data(), "timestamp": n.timestamp}
-            for n in notifications
+    return jsonify([n.to_event() for n in notifications])
+
+
+@app.route("/notifications/stream")
+@login_required
+def notification_stream():
+    if not app.config["NOTIFICATION_PUSH"]:
+        abort(404)
+    since = request.headers.get("Last-Event-ID", type=float)
+    if since is None:
+        since = request.args.get("since", type=float)
+    backlog = []
+    if since is not None:
+        backlog = [
+            n.to_event()
+            for n in current_user.notifications.filter(
+                Notification.timestamp > since
+            ).order_by(Notification.timestamp.asc())
         ]
+    user_id = current_user.id
+    db.session.remove()
+    return Response(
+        stream(user_id, backlog),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/user/<username>/export")
+@login_required
+@use_replica
+def export(username: str):
+    if username != current_user.username:
+        abort(403)
+    gzip = request.args.get("format") == "gzip"
+    filename = "{}.ndjson{}".format(username, ".gz" if gzip else "")
+    return Response(
+        stream_with_context(export_records(current_user.id, gzip)),
+        mimetype="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=" + filename},
     )
 
 
 @app.route("/user/<username>/popup")
 @login_required
+@use_replica
+@conditional(user_version)
 def user_popup(username: str):
     user = User.query.filter_by(username=username).first_or_404()
     form = EmptyForm()
@@ -369,24 +529,39 @@ def karmacomm(comment_id: int, change: str):
 def post(post_id: int):
     post = Post.query.filter_by(id=post_id).first_or_404()
     form = CommentForm()
-    page = request.args.get("page", 1, type=int)
+    parent = None
+    reply_to = request.args.get("reply_to", type=int)
+    if reply_to is not None:
+        parent = Comment.query.filter_by(id=reply_to, post_id=post.id).first_or_404()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data, post=post, author_id=current_user.id)
         db.session.add(comment)
+        comment.place(parent)
+        post.change_comment_count(1)
         db.session.commit()
+        invalidate("post", post.id)
         flash("Your comment has been published.")
-        return redirect(url_for("post", post_id=post.id, page=0))
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=app.config["POSTS_PER_PAGE"], error_out=False
+        return redirect(url_for("post", post_id=post.id))
+    pagination = keyset_paginate(
+        Comment.query.filter_by(post_id=post.id, depth=0),
+        (Comment.timestamp, Comment.id),
+    )
+    comments = Comment.threads(
+        post.id,
+        [root.id for root in pagination.items],
+        app.config["COMMENT_THREAD_REPLIES"],
+        app.config["COMMENT_THREAD_DEPTH"],
     )
-    comments = pagination.items
+    threads = {root.id: [] for root in pagination.items}
+    for comment in comments:
+        threads[comment.root_id].append(comment)
     next_url = (
-        url_for("post", post_id=post.id, page=pagination.next_num)
+        url_for("post", post_id=post.id, cursor=pagination.next_cursor)
         if pagination.has_next
         else None
     )
     prev_url = (
-        url_for("post", post_id=post.id, page=pagination.prev_num)
+        url_for("post", post_id=post.id, cursor=pagination.prev_cursor)
         if pagination.has_prev
         else None
     )
@@ -394,27 +569,70 @@ def post(post_id: int):
         "post.html",
         post=post,
         form=form,
-        comments=comments,
+        parent=parent,
+        threads=[threads[root.id] for root in pagination.items],
+        thread_depth=app.config["COMMENT_THREAD_DEPTH"],
         pagination=pagination,
         next_url=next_url,
         prev_url=prev_url,
     )
+
+
+@app.route("/post/<post_id>/comments/<int:comment_id>")
+@login_required
+@use_replica
+def comment_thread(post_id: int, comment_id: int):
+    post = Post.query.filter_by(id=post_id).first_or_404()
+    root = Comment.query.filter_by(id=comment_id, post_id=post.id).first_or_404()
+    pagination = keyset_paginate(
+        root.subtree(),
+        (Comment.path,),
+        per_page=app.config["COMMENTS_PER_PAGE"],
+        descending=False,
+    )
+    next_url = (
+        url_for(
+            "comment_thread",
+            post_id=post.id,
+            comment_id=root.id,
+            cursor=pagination.next_cursor,
+        )
+        if pagination.has_next
+        else None
+    )
+    prev_url = (
+        url_for(
+            "comment_thread",
+            post_id=post.id,
+            comment_id=root.id,
+            cursor=pagination.prev_cursor,
+        )
+        if pagination.has_prev
+        else None
+    )
+    return render_template(
+        "comment_thread.html",
+        post=post,
+        root=root,
+        comments=pagination.items,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
 @app.route("/communities", methods=["GET", "POST"])
 @login_required
 def communities():
-
     form = CommunityForm()
-    page = request.args.get("page", 1, type=int)
-    posts = Community.query.order_by(Community.name.desc()).paginate(
-        page, app.config["POSTS_PER_PAGE"], False
-    )
-    next_url = url_for("/community/<community_id>", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("/community/<community_id>", page=posts.prev_num) if posts.has_prev else None
+    query = Community.query.options(undefer(Community.member_count))
+    posts = keyset_paginate(query, (Community.name, Community.id))
+    next_url = url_for("communities", cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for("communities", cursor=posts.prev_cursor) if posts.has_prev else None
     if form.validate_on_submit():
         community = Community(name=form.name.data, about=form.about.data)
         db.session.add(community)
         db.session.commit()
-        return redirect(url_for("communities")) 
+        return redirect(url_for("communities"))
     return render_template(
         "community.html",
         title="Communities",
@@ -427,15 +645,33 @@ def communities():
 
 @app.route("/community/<community_id>", methods=["GET", "POST"])
 @login_required
+@conditional(
+    lambda community_id: (version("community", int(community_id)), window_token())
+    if community_id.isdigit()
+    else None
+)
 def community(community_id):
     community = Community.query.filter(Community.id == community_id).first_or_404()
     form = PostForm()
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.filter(Post.communityid == community_id).order_by(Post.timestamp.desc()).paginate(
-        page, app.config["POSTS_PER_PAGE"], False
+    sort, window = sort_args()
+    args = feed_args(sort, window)
+    posts = keyset_paginate(
+        *ranked(Post.query.filter(Post.communityid == community_id), sort, window)
+    )
+    next_url = (
+        url_for(
+            "community", community_id=community_id, cursor=posts.next_cursor, **args
+        )
+        if posts.has_next
+        else None
+    )
+    prev_url = (
+        url_for(
+            "community", community_id=community_id, cursor=posts.prev_cursor, **args
+        )
+        if posts.has_prev
+        else None
     )
-    next_url = url_for("/community/<community_id>", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("/community/<community_id>", page=posts.prev_num) if posts.has_prev else None
     if form.validate_on_submit():
         post = Post(body=form.post.data, author=current_user, communityid=community_id)
         db.session.add(post)
@@ -448,7 +684,11 @@ def community(community_id):
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
-        community=community
+        community=community,
+        sort=sort,
+        window=window,
+        sort_endpoint="community",
+        sort_kwargs={"community_id": community_id},
     )
 
 
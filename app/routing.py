@@ -0,0 +1,21 @@
+import random
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replicas = self.app.config["SQLALCHEMY_REPLICA_BINDS"]
+        if replicas and self.info.get("replica") and not self.info.get("primary"):
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info["primary"] = True
+            else:
+                state = get_state(self.app)
+                return state.db.get_engine(self.app, bind=random.choice(replicas))
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -1,31 +1,349 @@
-from flask import app
+import json
+import re
+from queue import Queue, Empty
+from threading import Lock, Thread
+from time import time, sleep
+from sqlalchemy import DDL, text
+from app import app, db
 
 
-def add_to_index(index, model):
-    if not app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    app.elasticsearch.index(index=index, id=model.id, body=payload)
+class SearchBackend(object):
+    def create(self, index, fields):
+        pass
 
+    def add(self, index, id, payload):
+        raise NotImplementedError
 
-def remove_from_index(index, model):
-    if not app.elasticsearch:
-        return
-    app.elasticsearch.delete(index=index, id=model.id)
+    def remove(self, index, id):
+        raise NotImplementedError
 
+    def query(self, index, query, page, per_page):
+        raise NotImplementedError
 
-def query_index(index, query, page, per_page):
-    if not app.elasticsearch:
+    def bulk(self, ops):
+        for action, index, id, payload in ops:
+            if action == "index":
+                self.add(index, id, payload)
+            else:
+                self.remove(index, id)
+
+
+class NullBackend(SearchBackend):
+    def add(self, index, id, payload):
+        pass
+
+    def remove(self, index, id):
+        pass
+
+    def query(self, index, query, page, per_page):
         return [], 0
-    search = app.elasticsearch.search(
-        index=index,
-        body={
-            "query": {"multi_match": {"query": query, "fields": ["*"]}},
-            "from": (page - 1) * per_page,
-            "size": per_page,
-        },
+
+
+class ElasticsearchBackend(SearchBackend):
+    def add(self, index, id, payload):
+        app.elasticsearch.index(index=index, id=id, body=payload)
+
+    def remove(self, index, id):
+        app.elasticsearch.delete(index=index, id=id)
+
+    def query(self, index, query, page, per_page):
+        search = app.elasticsearch.search(
+            index=index,
+            body={
+                "query": {"multi_match": {"query": query, "fields": ["*"]}},
+                "from": (page - 1) * per_page,
+                "size": per_page,
+            },
+        )
+        ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+        return ids, search["hits"]["total"]["value"]
+
+    def bulk(self, ops):
+        body = []
+        for action, index, id, payload in ops:
+            body.append({action: {"_index": index, "_id": id}})
+            if action == "index":
+                body.append(payload)
+        result = app.elasticsearch.bulk(body=body)
+        if result["errors"]:
+            failed = [
+                item
+                for item in result["items"]
+                for action, status in item.items()
+                if status.get("error")
+                and not (action == "delete" and status.get("status") == 404)
+            ]
+            if failed:
+                raise RuntimeError("Bulk indexing failed: {}".format(failed[:3]))
+
+
+class SQLiteFTSBackend(SearchBackend):
+    @staticmethod
+    def table(index):
+        return index + "_search"
+
+    @classmethod
+    def ddl(cls, index, fields):
+        return "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({})".format(
+            cls.table(index), ", ".join(fields)
+        )
+
+    @staticmethod
+    def match(query):
+        return " ".join('"{}"'.format(term) for term in re.findall(r"\w+", query))
+
+    def create(self, index, fields):
+        with db.engine.begin() as conn:
+            conn.execute(text(self.ddl(index, fields)))
+
+    def _write(self, conn, action, index, id, payload):
+        conn.execute(
+            text("DELETE FROM {} WHERE rowid = :id".format(self.table(index))),
+            {"id": id},
+        )
+        if action == "index":
+            conn.execute(
+                text(
+                    "INSERT INTO {} (rowid, {}) VALUES (:id, {})".format(
+                        self.table(index),
+                        ", ".join(payload),
+                        ", ".join(":" + field for field in payload),
+                    )
+                ),
+                dict(payload, id=id),
+            )
+
+    def add(self, index, id, payload):
+        self.bulk([("index", index, id, payload)])
+
+    def remove(self, index, id):
+        self.bulk([("delete", index, id, None)])
+
+    def bulk(self, ops):
+        with db.engine.begin() as conn:
+            for op in ops:
+                self._write(conn, *op)
+
+    def query(self, index, query, page, per_page):
+        match = self.match(query)
+        if not match:
+            return [], 0
+        table = self.table(index)
+        with db.engine.connect() as conn:
+            ids = conn.execute(
+                text(
+                    "SELECT rowid FROM {0} WHERE {0} MATCH :match "
+                    "ORDER BY bm25({0}) LIMIT :limit OFFSET :offset".format(table)
+                ),
+                {"match": match, "limit": per_page, "offset": (page - 1) * per_page},
+            ).scalars().all()
+            total = conn.execute(
+                text("SELECT count(*) FROM {0} WHERE {0} MATCH :match".format(table)),
+                {"match": match},
+            ).scalar()
+        return ids, total
+
+
+def register_index(model):
+    index = model.__tablename__
+    db.event.listen(
+        model.__table__,
+        "after_create",
+        DDL(SQLiteFTSBackend.ddl(index, model.__searchable__)).execute_if(
+            dialect="sqlite"
+        ),
     )
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
-    return ids, search["hits"]["total"]["value"]
+    db.event.listen(
+        model.__table__,
+        "before_drop",
+        DDL("DROP TABLE IF EXISTS {}".format(SQLiteFTSBackend.table(index))).execute_if(
+            dialect="sqlite"
+        ),
+    )
+
+
+BACKENDS = {
+    "elasticsearch": ElasticsearchBackend,
+    "sqlite": SQLiteFTSBackend,
+    "null": NullBackend,
+}
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        name = app.config["SEARCH_BACKEND"]
+        if name is None:
+            if app.elasticsearch:
+                name = "elasticsearch"
+            elif db.engine.dialect.name == "sqlite":
+                name = "sqlite"
+            else:
+                name = "null"
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def process_batch(ops):
+    retries = app.config["SEARCH_RETRIES"]
+    for attempt in range(retries + 1):
+        try:
+            get_backend().bulk(ops)
+            return
+        except Exception:
+            if attempt == retries:
+                raise
+            app.logger.warning(
+                "Search batch of %d failed, retrying (%d)", len(ops), attempt + 1
+            )
+            sleep(app.config["SEARCH_RETRY_BACKOFF"] * 2 ** attempt)
+
+
+class SyncQueue(object):
+    def put(self, ops):
+        process_batch(ops)
+
+    def join(self):
+        pass
+
+    def depth(self):
+        return 0
+
+
+class ThreadQueue(object):
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+    def put(self, ops):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        for op in ops:
+            self.queue.put(op)
+
+    def batch(self):
+        batch = [self.queue.get()]
+        deadline = time() + app.config["SEARCH_BATCH_INTERVAL"]
+        while len(batch) < app.config["SEARCH_BATCH_SIZE"]:
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - time(), 0)))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.batch()
+            try:
+                with app.app_context():
+                    process_batch(batch)
+            except Exception:
+                app.logger.exception("Dropped search batch of %d", len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+class RQQueue(object):
+    key = "roblog:search"
+
+    def __init__(self):
+        from redis import Redis
+        import rq
+
+        self.redis = Redis.from_url(app.config["REDIS_URL"])
+        self.queue = rq.Queue("roblog-search", connection=self.redis)
+
+    def put(self, ops):
+        self.redis.rpush(self.key, *[json.dumps(op) for op in ops])
+        self.queue.enqueue("app.search.drain")
+
+    def join(self):
+        pass
+
+    def depth(self):
+        return self.redis.llen(self.key)
+
+    def drain(self):
+        size = app.config["SEARCH_BATCH_SIZE"]
+        while True:
+            pipe = self.redis.pipeline()
+            pipe.lrange(self.key, 0, size - 1)
+            pipe.ltrim(self.key, size, -1)
+            raw, _ = pipe.execute()
+            if not raw:
+                return
+            try:
+                process_batch([json.loads(op) for op in raw])
+            except Exception:
+                self.redis.rpush(self.key, *raw)
+                raise
+
+
+QUEUES = {"sync": SyncQueue, "thread": ThreadQueue, "rq": RQQueue}
+_queues = {}
+
+
+def get_queue():
+    name = app.config["SEARCH_QUEUE"]
+    if name not in _queues:
+        _queues[name] = QUEUES[name]()
+    return _queues[name]
+
+
+def enqueue(ops):
+    if ops:
+        get_queue().put(ops)
+
+
+def drain():
+    with app.app_context():
+        get_queue().drain()
+
+
+def reindex(model, chunk_size: int):
+    index, fields = model.__tablename__, model.__searchable__
+    create_index(index, fields)
+    columns = [model.id] + [getattr(model, field) for field in fields]
+    last, total = 0, 0
+    while True:
+        rows = (
+            db.session.query(*columns)
+            .filter(model.id > last)
+            .order_by(model.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            return total
+        process_batch(
+            [("index", index, row[0], dict(zip(fields, row[1:]))) for row in rows]
+        )
+        last = rows[-1][0]
+        total += len(rows)
+
+
+def create_index(index, fields):
+    get_backend().create(index, fields)
+
+
+def add_to_index(index, id, payload):
+    get_backend().add(index, id, payload)
+
+
+def remove_from_index(index, id):
+    get_backend().remove(index, id)
+
+
+def query_index(index, query, page, per_page):
+    return get_backend().query(index, query, page, per_page)
@@ -0,0 +1,236 @@
+import random
+from itertools import accumulate
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from app import app, db
+from app.models import (
+    User,
+    Post,
+    Comment,
+    Message,
+    Conversation,
+    Community,
+    followers,
+    users_in_communities,
+    voted_by,
+    voted_by_comm,
+    hot_score,
+    comment_path,
+)
+from app import timeline
+
+
+WORDS = (
+    "robot gear bolt laser circuit servo sensor steel spark oil wheel cable chip "
+    "motor arm drone beep relay socket firmware battery"
+).split()
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def sentence(rng, words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def insert(table, rows, chunk_size: int = 5000):
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(table.insert(), rows[i : i + chunk_size])
+
+
+def seed(
+    users: int = 200,
+    posts: int = 2000,
+    comments: int = 5000,
+    votes: int = 10000,
+    messages: int = 1000,
+    communities: int = 10,
+    follows: int = 20,
+    celebrities: int = 5,
+    skew: float = 1.1,
+    days: int = 30,
+    password: str = "bench",
+    random_seed: int = 0,
+):
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+
+    def ago():
+        return now - timedelta(seconds=rng.uniform(0, days * 86400))
+
+    first_user = next_id(User)
+    user_ids = list(range(first_user, first_user + users))
+    # Low ids are the "celebrities": they post more, get followed by half of
+    # the site and collect most of the votes.
+    weights = [1 / (rank + 1) ** skew for rank in range(users)]
+    user_weights = list(accumulate(weights))
+    password_hash = generate_password_hash(password)
+    user_rows = [
+        {
+            "id": id,
+            "username": "bench%d" % id,
+            "email": "bench%d@example.com" % id,
+            "password_hash": password_hash,
+            "about_me": sentence(rng, 6),
+            "last_seen": ago(),
+            "karma": 0,
+        }
+        for id in user_ids
+    ]
+
+    follow_pairs = set()
+    for follower in user_ids:
+        for followed in user_ids[:celebrities]:
+            if rng.random() < 0.5:
+                follow_pairs.add((follower, followed))
+        for followed in rng.choices(user_ids, cum_weights=user_weights, k=follows):
+            follow_pairs.add((follower, followed))
+    follow_pairs = {(a, b) for a, b in follow_pairs if a != b}
+
+    first_community = next_id(Community)
+    community_ids = list(range(first_community, first_community + communities))
+    community_rows = [
+        {"id": id, "name": "bench-community-%d" % id, "about": sentence(rng, 8)}
+        for id in community_ids
+    ]
+    memberships = set()
+    if community_ids:
+        for user_id in user_ids:
+            for community_id in rng.sample(community_ids, rng.randint(0, 3)):
+                memberships.add((user_id, community_id))
+
+    first_post = next_id(Post)
+    post_rows = [
+        {
+            "id": first_post + i,
+            "user_id": author,
+            "body": sentence(rng, rng.randint(3, 20))[:140],
+            "timestamp": ago(),
+            "communityid": rng.choice(community_ids)
+            if community_ids and rng.random() < 0.3
+            else None,
+            "karma": 0,
+            "comment_count": 0,
+        }
+        for i, author in enumerate(
+            rng.choices(user_ids, cum_weights=user_weights, k=posts)
+        )
+    ]
+    post_weights = list(
+        accumulate(weights[row["user_id"] - first_user] for row in post_rows)
+    )
+
+    first_comment = next_id(Comment)
+    comment_rows = []
+    commented = rng.choices(post_rows, cum_weights=post_weights, k=comments)
+    threads = {}
+    for i, post in enumerate(commented):
+        post["comment_count"] += 1
+        comment_id = first_comment + i
+        siblings = threads.setdefault(post["id"], [])
+        parent = rng.choice(siblings) if siblings and rng.random() < 0.6 else None
+        if parent is not None and parent["depth"] >= app.config["COMMENT_MAX_DEPTH"]:
+            parent = None
+        row = {
+            "id": comment_id,
+            "post_id": post["id"],
+            "author_id": rng.choice(user_ids),
+            "body": sentence(rng, rng.randint(2, 12)),
+            "timestamp": (parent or post)["timestamp"]
+            + timedelta(minutes=rng.randint(1, 600)),
+            "karma": 0,
+            "parent_id": parent["id"] if parent else None,
+            "root_id": parent["root_id"] if parent else comment_id,
+            "path": comment_path(parent["path"] if parent else None, comment_id),
+            "depth": parent["depth"] + 1 if parent else 0,
+            "descendant_count": 0,
+            "reply_count": 0,
+        }
+        if parent is not None:
+            parent["reply_count"] += 1
+        for ancestor in row["path"].split(".")[:-1]:
+            comment_rows[int(ancestor) - first_comment]["descendant_count"] += 1
+        siblings.append(row)
+        comment_rows.append(row)
+
+    karma = dict.fromkeys(user_ids, 0)
+    post_votes, comment_votes = {}, {}
+    for _ in range(votes):
+        user_id = rng.choice(user_ids)
+        direction = 1 if rng.random() < 0.8 else -1
+        if comment_rows and rng.random() < 0.3:
+            target, seen = rng.choice(comment_rows), comment_votes
+            author = target["author_id"]
+        else:
+            target = rng.choices(post_rows, cum_weights=post_weights)[0]
+            seen, author = post_votes, target["user_id"]
+        if author == user_id or (user_id, target["id"]) in seen:
+            continue
+        seen[(user_id, target["id"])] = direction
+        target["karma"] += direction
+        karma[author] += direction
+    for row in user_rows:
+        row["karma"] = karma[row["id"]]
+    for row in post_rows:
+        row["hot"] = hot_score(row["karma"], row["timestamp"], now)
+
+    first_message = next_id(Message)
+    message_rows = []
+    for i in range(messages):
+        sender, recipient = rng.sample(user_ids, 2)
+        message_rows.append(
+            {
+                "id": first_message + i,
+                "sender_id": sender,
+                "recipient_id": recipient,
+                "body": sentence(rng, rng.randint(2, 12))[:140],
+                "timestamp": ago(),
+            }
+        )
+
+    insert(User.__table__, user_rows)
+    insert(Community.__table__, community_rows)
+    insert(
+        followers,
+        [{"follower_id": a, "followed_id": b} for a, b in sorted(follow_pairs)],
+    )
+    insert(
+        users_in_communities,
+        [{"user_id": a, "community_id": b} for a, b in sorted(memberships)],
+    )
+    insert(Post.__table__, post_rows)
+    insert(Comment.__table__, comment_rows)
+    insert(
+        voted_by,
+        [
+            {"user_id": a, "post_id": b, "direction": d}
+            for (a, b), d in post_votes.items()
+        ],
+    )
+    insert(
+        voted_by_comm,
+        [
+            {"user_id": a, "comments_id": b, "direction": d}
+            for (a, b), d in comment_votes.items()
+        ],
+    )
+    insert(Message.__table__, message_rows)
+    Conversation.rebuild()
+    User.recount_unread_messages()
+    if app.config["TIMELINE_ENABLED"]:
+        conn = db.session.connection()
+        for user_id in user_ids:
+            timeline.rebuild(conn, user_id)
+    db.session.commit()
+    Post.reindex()
+    return {
+        "users": len(user_rows),
+        "follows": len(follow_pairs),
+        "communities": len(community_rows),
+        "memberships": len(memberships),
+        "posts": len(post_rows),
+        "comments": len(comment_rows),
+        "votes": len(post_votes) + len(comment_votes),
+        "messages": len(message_rows),
+    }
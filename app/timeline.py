@@ -0,0 +1,261 @@
+from sqlalchemy import select, literal, exists, and_, or_, union
+from app import app, db
+from app.models import User, Post, Community, followers, users_in_communities, timeline
+
+
+post_table = Post.__table__
+
+
+def _missing(user_id: int):
+    return ~exists().where(
+        and_(timeline.c.user_id == user_id, timeline.c.post_id == post_table.c.id)
+    )
+
+
+def _insert_posts(conn, user_id: int, whereclause):
+    conn.execute(
+        timeline.insert().from_select(
+            ["user_id", "post_id", "timestamp"],
+            select(
+                literal(user_id), post_table.c.id, post_table.c.timestamp
+            ).where(and_(whereclause, _missing(user_id))),
+        )
+    )
+
+
+def _delete_posts(conn, user_id: int, post_ids):
+    conn.execute(
+        timeline.delete().where(
+            and_(timeline.c.user_id == user_id, timeline.c.post_id.in_(post_ids))
+        )
+    )
+
+
+def push_post(conn, post_id: int):
+    row = conn.execute(
+        select(
+            post_table.c.user_id, post_table.c.communityid, post_table.c.timestamp
+        ).where(post_table.c.id == post_id)
+    ).first()
+    if row is None:
+        return
+    readers = [
+        select(followers.c.follower_id.label("user_id")).where(
+            followers.c.followed_id == row.user_id
+        ),
+        select(literal(row.user_id).label("user_id")),
+    ]
+    if row.communityid is not None:
+        readers.append(
+            select(users_in_communities.c.user_id).where(
+                users_in_communities.c.community_id == row.communityid
+            )
+        )
+    readers = union(*readers).subquery()
+    conn.execute(
+        timeline.insert().from_select(
+            ["user_id", "post_id", "timestamp"],
+            select(
+                readers.c.user_id,
+                literal(post_id),
+                literal(row.timestamp, db.DateTime),
+            ).where(
+                ~exists().where(
+                    and_(
+                        timeline.c.user_id == readers.c.user_id,
+                        timeline.c.post_id == post_id,
+                    )
+                )
+            ),
+        )
+    )
+
+
+def remove_post(conn, post_id: int):
+    conn.execute(timeline.delete().where(timeline.c.post_id == post_id))
+
+
+def backfill_followed(conn, user_id: int, followed_id: int):
+    _insert_posts(conn, user_id, post_table.c.user_id == followed_id)
+
+
+def prune_followed(conn, user_id: int, followed_id: int):
+    joined = select(users_in_communities.c.community_id).where(
+        users_in_communities.c.user_id == user_id
+    )
+    _delete_posts(
+        conn,
+        user_id,
+        select(post_table.c.id).where(
+            and_(
+                post_table.c.user_id == followed_id,
+                or_(
+                    post_table.c.communityid == None,
+                    post_table.c.communityid.notin_(joined),
+                ),
+            )
+        ),
+    )
+
+
+def backfill_community(conn, user_id: int, community_id: int):
+    _insert_posts(conn, user_id, post_table.c.communityid == community_id)
+
+
+def prune_community(conn, user_id: int, community_id: int):
+    followed = select(followers.c.followed_id).where(
+        followers.c.follower_id == user_id
+    )
+    _delete_posts(
+        conn,
+        user_id,
+        select(post_table.c.id).where(
+            and_(
+                post_table.c.communityid == community_id,
+                post_table.c.user_id != user_id,
+                post_table.c.user_id.notin_(followed),
+            )
+        ),
+    )
+
+
+def rebuild(conn, user_id: int):
+    followed = select(followers.c.followed_id).where(
+        followers.c.follower_id == user_id
+    )
+    joined = select(users_in_communities.c.community_id).where(
+        users_in_communities.c.user_id == user_id
+    )
+    conn.execute(timeline.delete().where(timeline.c.user_id == user_id))
+    _insert_posts(
+        conn,
+        user_id,
+        or_(
+            post_table.c.user_id == user_id,
+            post_table.c.user_id.in_(followed),
+            post_table.c.communityid.in_(joined),
+        ),
+    )
+
+
+TASKS = {
+    f.__name__: f
+    for f in (
+        push_post,
+        remove_post,
+        backfill_followed,
+        prune_followed,
+        backfill_community,
+        prune_community,
+        rebuild,
+    )
+}
+
+
+def run_task(task: str, *args):
+    with app.app_context():
+        TASKS[task](db.session.connection(), *args)
+        db.session.commit()
+
+
+class InlineWorker(object):
+    deferred = False
+
+    def submit(self, task: str, *args):
+        run_task(task, *args)
+
+
+class RQWorker(object):
+    deferred = True
+
+    def __init__(self):
+        from redis import Redis
+        import rq
+
+        self.queue = rq.Queue(
+            "roblog-timeline", connection=Redis.from_url(app.config["REDIS_URL"])
+        )
+
+    def submit(self, task: str, *args):
+        self.queue.enqueue("app.timeline.run_task", task, *args)
+
+
+WORKERS = {"inline": InlineWorker, "rq": RQWorker}
+_worker = None
+
+
+def get_worker():
+    global _worker
+    if _worker is None:
+        _worker = WORKERS[app.config["TIMELINE_WORKER"]]()
+    return _worker
+
+
+def set_worker(worker):
+    global _worker
+    _worker = worker
+
+
+def schedule(task: str, *refs):
+    if not app.config["TIMELINE_ENABLED"]:
+        return
+    db.session.info.setdefault("timeline_pending", []).append((task, refs))
+
+
+@db.event.listens_for(User.followed, "append")
+def _on_follow(user, followed, initiator):
+    schedule("backfill_followed", user, followed)
+
+
+@db.event.listens_for(User.followed, "remove")
+def _on_unfollow(user, followed, initiator):
+    schedule("prune_followed", user, followed)
+
+
+@db.event.listens_for(Community.users_in_communities, "append")
+def _on_join(community, user, initiator):
+    schedule("backfill_community", user, community)
+
+
+@db.event.listens_for(Community.users_in_communities, "remove")
+def _on_leave(community, user, initiator):
+    schedule("prune_community", user, community)
+
+
+@db.event.listens_for(Post, "after_insert")
+def _on_post_insert(mapper, connection, post):
+    schedule("push_post", post)
+
+
+@db.event.listens_for(Post, "after_delete")
+def _on_post_delete(mapper, connection, post):
+    schedule("remove_post", post.id)
+
+
+@db.event.listens_for(db.session, "after_flush_postexec")
+def _after_flush(session, flush_context):
+    pending = session.info.pop("timeline_pending", None)
+    if not pending:
+        return
+    ready = [
+        (task, tuple(getattr(ref, "id", ref) for ref in refs))
+        for task, refs in pending
+    ]
+    if get_worker().deferred:
+        session.info.setdefault("timeline_ready", []).extend(ready)
+        return
+    conn = session.connection()
+    for task, args in ready:
+        TASKS[task](conn, *args)
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _after_commit(session):
+    for task, args in session.info.pop("timeline_ready", []):
+        get_worker().submit(task, *args)
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _after_rollback(session, previous_transaction):
+    session.info.pop("timeline_pending", None)
+    session.info.pop("timeline_ready", None)
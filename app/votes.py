@@ -0,0 +1,66 @@
+from app import db
+from app.models import (
+    User,
+    Post,
+    Comment,
+    voted_by,
+    voted_by_comm,
+    cast_vote,
+    touch,
+    expire_user,
+    rescore,
+    VOTE_DIRECTIONS,
+)
+
+
+TARGETS = {
+    "post": (Post, voted_by, "post_id", Post.user_id),
+    "comment": (Comment, voted_by_comm, "comments_id", Comment.author_id),
+}
+
+
+def _apply_deltas(model, deltas):
+    params = [{"target": id, "delta": delta} for id, delta in deltas.items() if delta]
+    if not params:
+        return
+    table = model.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == db.bindparam("target"))
+        .values(karma=table.c.karma + db.bindparam("delta")),
+        params,
+    )
+
+
+def apply_votes(votes):
+    accepted = 0
+    for kind, (model, table, target_column, author_column) in TARGETS.items():
+        batch = [v for v in votes if v.get(kind + "_id") is not None]
+        if not batch:
+            continue
+        ids = {v[kind + "_id"] for v in batch}
+        authors = dict(
+            db.session.query(model.id, author_column).filter(model.id.in_(ids))
+        )
+        target_deltas, user_deltas = {}, {}
+        for vote in batch:
+            target_id = vote[kind + "_id"]
+            direction = VOTE_DIRECTIONS.get(vote.get("change"))
+            author_id = authors.get(target_id)
+            if direction is None or author_id in (None, vote["user_id"]):
+                continue
+            if cast_vote(table, target_column, target_id, vote["user_id"], direction):
+                accepted += 1
+                target_deltas[target_id] = target_deltas.get(target_id, 0) + direction
+                user_deltas[author_id] = user_deltas.get(author_id, 0) + direction
+        _apply_deltas(model, target_deltas)
+        _apply_deltas(User, user_deltas)
+        for author_id in user_deltas:
+            touch("user", author_id)
+            expire_user(author_id)
+        if model is Post and target_deltas:
+            for post in Post.query.filter(Post.id.in_(list(target_deltas))):
+                post.touch()
+                rescore(post.id)
+    db.session.commit()
+    return accepted
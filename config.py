@@ -12,7 +12,46 @@ class Config(object):
         "DATABASE_URL"
     ) or "sqlite:///" + os.path.join(basedir, "app.db")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_BINDS = {
+        "replica%d" % i: url
+        for i, url in enumerate(
+            filter(None, (os.environ.get("DATABASE_REPLICA_URLS") or "").split(","))
+        )
+    }
+    SQLALCHEMY_REPLICA_BINDS = sorted(SQLALCHEMY_BINDS)
+    REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS") or 5)
+    SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE") or "WAL"
+    SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS") or "NORMAL"
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT") or 5000)
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE") or 256 * 1024 * 1024)
+    SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE") or -64 * 1024)
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE") or 10)
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW") or 20)
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE") or 1800)
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT") or 30)
+    SQLALCHEMY_ENGINE_OPTIONS = (
+        {}
+        if SQLALCHEMY_DATABASE_URI.startswith("sqlite")
+        else {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_pre_ping": True,
+        }
+    )
     POSTS_PER_PAGE = 8
+    COMMENTS_PER_PAGE = 50
+    COMMENT_THREAD_REPLIES = 5
+    COMMENT_THREAD_DEPTH = 4
+    COMMENT_MAX_DEPTH = 16
+    HOT_GRAVITY = 1.8
+    HOT_HORIZON_HOURS = 7 * 24
+    HOT_BATCH_SIZE = 1000
+    TOP_WINDOW_STEP = 300
+    FEED_VERSION_SHARDS = int(os.environ.get("FEED_VERSION_SHARDS") or 16)
+    API_PER_PAGE = 25
+    API_MAX_PER_PAGE = 100
     MAIL_SERVER = "smtp.googlemail.com"
     MAIL_PORT = "587"
     MAIL_USE_TLS = 1
@@ -20,3 +59,46 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD") or "enter pass"
     ADMINS = os.environ.get("ADMINS") or "enter admin"
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
+    REDIS_URL = os.environ.get("REDIS_URL") or "redis://"
+    TIMELINE_ENABLED = bool(os.environ.get("TIMELINE_ENABLED"))
+    TIMELINE_WORKER = os.environ.get("TIMELINE_WORKER") or "inline"
+    LAST_SEEN_BACKEND = os.environ.get("LAST_SEEN_BACKEND") or "memory"
+    LAST_SEEN_GRANULARITY = int(os.environ.get("LAST_SEEN_GRANULARITY") or 5)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 60)
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND")
+    SEARCH_QUEUE = os.environ.get("SEARCH_QUEUE") or "thread"
+    SEARCH_BATCH_SIZE = 500
+    SEARCH_BATCH_INTERVAL = 1.0
+    SEARCH_RETRIES = 3
+    SEARCH_RETRY_BACKOFF = 0.5
+    MAIL_POOL_SIZE = int(os.environ.get("MAIL_POOL_SIZE") or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE") or 100)
+    MAIL_IDLE_TIMEOUT = 30
+    MAIL_CAPTURE = bool(os.environ.get("MAIL_CAPTURE"))
+    # Each open stream holds a worker until it times out, so only enable push
+    # behind an async worker class (gunicorn -k gevent or eventlet).
+    NOTIFICATION_PUSH = os.environ.get("NOTIFICATION_PUSH") == "1"
+    NOTIFICATION_BROKER = os.environ.get("NOTIFICATION_BROKER") or "memory"
+    NOTIFICATION_HEARTBEAT = int(os.environ.get("NOTIFICATION_HEARTBEAT") or 10)
+    NOTIFICATION_STREAM_TIMEOUT = int(
+        os.environ.get("NOTIFICATION_STREAM_TIMEOUT") or 60
+    )
+    NOTIFICATION_TTL = int(os.environ.get("NOTIFICATION_TTL") or 7 * 24 * 3600)
+    NOTIFICATION_COMPACT_BATCH_SIZE = 1000
+    FRAGMENT_CACHE = os.environ.get("FRAGMENT_CACHE") or "memory"
+    FRAGMENT_CACHE_SIZE = 4096
+    FRAGMENT_CACHE_TTL = 600
+    AVATAR_STORE = os.environ.get("AVATAR_STORE") or "disk"
+    AVATAR_DIR = os.environ.get("AVATAR_DIR") or os.path.join(basedir, "avatars")
+    AVATAR_CACHE_SIZE = 2048
+    AVATAR_FORMAT = os.environ.get("AVATAR_FORMAT") or "png"
+    AVATAR_SIZES = (100, 256)
+    AVATAR_VERSION = 1
+    AVATAR_MAX_AGE = 31536000
+    USER_CACHE = os.environ.get("USER_CACHE") or "memory"
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+    N_PLUS_ONE_THRESHOLD = 5
+    SLOW_QUERY_THRESHOLD = 0.5
+    EXPORT_CHUNK_SIZE = 1000
+    EXPORT_BUFFER_SIZE = 64 * 1024
@@ -0,0 +1,139 @@
+"""baseline schema
+
+Revision ID: 1f0c9a2d7b64
+Revises:
+Create Date: 2026-10-18 08:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f0c9a2d7b64'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# The schema db.create_all() produced before the project had migrations,
+# including the swapped foreign keys on the vote and membership tables that
+# 5b2e7c41d0a9 repairs. Tables that already exist are left alone, so
+# databases created that way can run 'flask db upgrade' directly.
+def tables():
+    yield 'user', [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=32), nullable=True),
+        sa.Column('email', sa.String(length=64), nullable=True),
+        sa.Column('password_hash', sa.String(length=128), nullable=True),
+        sa.Column('about_me', sa.String(length=128), nullable=True),
+        sa.Column('last_seen', sa.DateTime(), nullable=True),
+        sa.Column('karma', sa.Integer(), nullable=True),
+        sa.Column('last_message_read_time', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    ], [
+        ('ix_user_id', ['id'], False),
+        ('ix_user_username', ['username'], True),
+        ('ix_user_email', ['email'], True),
+    ]
+    yield 'community', [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=32), nullable=True),
+        sa.Column('about', sa.String(length=164), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    ], [
+        ('ix_community_id', ['id'], False),
+        ('ix_community_name', ['name'], True),
+    ]
+    yield 'followers', [
+        sa.Column('follower_id', sa.Integer(), nullable=True),
+        sa.Column('followed_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['follower_id'], ['user.id']),
+        sa.ForeignKeyConstraint(['followed_id'], ['user.id']),
+    ], []
+    yield 'users_in_communities', [
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('community_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['community.id']),
+        sa.ForeignKeyConstraint(['community_id'], ['user.id']),
+    ], []
+    yield 'post', [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('communityid', sa.Integer(), nullable=True),
+        sa.Column('body', sa.String(length=140), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('karma', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['communityid'], ['community.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+    ], [
+        ('ix_post_id', ['id'], False),
+        ('ix_post_timestamp', ['timestamp'], False),
+    ]
+    yield 'message', [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sender_id', sa.Integer(), nullable=True),
+        sa.Column('recipient_id', sa.Integer(), nullable=True),
+        sa.Column('body', sa.String(length=140), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['sender_id'], ['user.id']),
+        sa.ForeignKeyConstraint(['recipient_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+    ], [
+        ('ix_message_timestamp', ['timestamp'], False),
+    ]
+    yield 'notification', [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('timestamp', sa.Float(), nullable=True),
+        sa.Column('payload_json', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+    ], [
+        ('ix_notification_name', ['name'], False),
+        ('ix_notification_timestamp', ['timestamp'], False),
+    ]
+    yield 'voted_by', [
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('post_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['post.id']),
+        sa.ForeignKeyConstraint(['post_id'], ['user.id']),
+    ], []
+    yield 'comments', [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=True),
+        sa.Column('body_html', sa.Text(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.Column('author_id', sa.Integer(), nullable=True),
+        sa.Column('post_id', sa.Integer(), nullable=True),
+        sa.Column('karma', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['author_id'], ['user.id']),
+        sa.ForeignKeyConstraint(['post_id'], ['post.id']),
+        sa.PrimaryKeyConstraint('id'),
+    ], [
+        ('ix_comments_id', ['id'], False),
+        ('ix_comments_timestamp', ['timestamp'], False),
+    ]
+    yield 'voted_by_comm', [
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('comments_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['comments.id']),
+        sa.ForeignKeyConstraint(['comments_id'], ['user.id']),
+    ], []
+
+
+def upgrade():
+    existing = sa.inspect(op.get_bind()).get_table_names()
+    for name, columns, indexes in tables():
+        if name in existing:
+            continue
+        op.create_table(name, *columns)
+        for index, index_columns, unique in indexes:
+            op.create_index(index, name, index_columns, unique=unique)
+
+
+def downgrade():
+    for name, columns, indexes in reversed(list(tables())):
+        op.drop_table(name)
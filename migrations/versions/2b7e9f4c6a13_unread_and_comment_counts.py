@@ -0,0 +1,53 @@
+"""unread and comment counts
+
+Revision ID: 2b7e9f4c6a13
+Revises: 9a4d2c7e1b58
+Create Date: 2026-10-18 08:30:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7e9f4c6a13'
+down_revision = '9a4d2c7e1b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('unread_message_count', sa.Integer(),
+                                    server_default='0', nullable=True))
+    op.add_column('post', sa.Column('comment_count', sa.Integer(),
+                                    server_default='0', nullable=True))
+    user = sa.table('user', sa.column('id'),
+                    sa.column('last_message_read_time', sa.DateTime()),
+                    sa.column('unread_message_count'))
+    message = sa.table('message', sa.column('id'), sa.column('recipient_id'),
+                       sa.column('timestamp', sa.DateTime()))
+    post = sa.table('post', sa.column('id'), sa.column('comment_count'))
+    comments = sa.table('comments', sa.column('id'), sa.column('post_id'))
+    # Built as expressions so each dialect decides how to quote "user";
+    # a literal "user" is a string, not a table, on MySQL.
+    op.execute(user.update().values(unread_message_count=(
+        sa.select(sa.func.count(message.c.id))
+        .where(message.c.recipient_id == user.c.id)
+        .where(message.c.timestamp > sa.func.coalesce(
+            user.c.last_message_read_time, datetime(1900, 1, 1)))
+        .scalar_subquery()
+    )))
+    op.execute(post.update().values(comment_count=(
+        sa.select(sa.func.count(comments.c.id))
+        .where(comments.c.post_id == post.c.id)
+        .scalar_subquery()
+    )))
+
+
+def downgrade():
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.drop_column('comment_count')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('unread_message_count')
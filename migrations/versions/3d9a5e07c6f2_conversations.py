@@ -0,0 +1,67 @@
+"""conversations
+
+Revision ID: 3d9a5e07c6f2
+Revises: 8c1f4a6e2b37
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d9a5e07c6f2'
+down_revision = '8c1f4a6e2b37'
+branch_labels = None
+depends_on = None
+
+
+# Existing messages have no conversation yet; run `flask counters repair`
+# once to group them and fill in the summaries.
+def upgrade():
+    op.create_table(
+        'conversation',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_a_id', sa.Integer(), nullable=False),
+        sa.Column('user_b_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_a_id'], ['user.id']),
+        sa.ForeignKeyConstraint(['user_b_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_a_id', 'user_b_id'),
+    )
+    op.create_table(
+        'conversation_member',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('conversation_id', sa.Integer(), nullable=False),
+        sa.Column('peer_id', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.Column('read_at', sa.DateTime(), nullable=True),
+        sa.Column('unread_count', sa.Integer(), server_default='0',
+                  nullable=True),
+        sa.ForeignKeyConstraint(['conversation_id'], ['conversation.id']),
+        sa.ForeignKeyConstraint(['peer_id'], ['user.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('user_id', 'conversation_id'),
+    )
+    op.create_index('ix_conversation_member_user_id_timestamp',
+                    'conversation_member',
+                    ['user_id', 'timestamp', 'conversation_id'])
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(),
+                                      nullable=True))
+        batch_op.create_foreign_key('fk_message_conversation_id',
+                                    'conversation', ['conversation_id'], ['id'])
+        batch_op.create_index('ix_message_conversation_id_timestamp',
+                              ['conversation_id', 'timestamp', 'id'])
+
+
+def downgrade():
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.drop_index('ix_message_conversation_id_timestamp')
+        batch_op.drop_column('conversation_id')
+    op.drop_index('ix_conversation_member_user_id_timestamp',
+                  table_name='conversation_member')
+    op.drop_table('conversation_member')
+    op.drop_table('conversation')
@@ -0,0 +1,77 @@
+"""association table keys
+
+Revision ID: 5b2e7c41d0a9
+Revises: e8c4b6a2d9f1
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e7c41d0a9'
+down_revision = 'e8c4b6a2d9f1'
+branch_labels = None
+depends_on = None
+
+
+# table: (first key column, referenced table), (second key column, referenced
+# table), has a vote direction column
+TABLES = {
+    'followers': (('follower_id', 'user'), ('followed_id', 'user'), False),
+    'voted_by': (('user_id', 'user'), ('post_id', 'post'), True),
+    'voted_by_comm': (('user_id', 'user'), ('comments_id', 'comments'), True),
+    'users_in_communities': (
+        ('user_id', 'user'), ('community_id', 'community'), False
+    ),
+}
+
+
+def rebuild(name, first, second, voted, keyed):
+    inspector = sa.inspect(op.get_bind())
+    if name not in inspector.get_table_names():
+        return
+    has_direction = 'direction' in [c['name'] for c in inspector.get_columns(name)]
+    tmp = name + '_tmp'
+    columns = [
+        sa.Column(first[0], sa.Integer, sa.ForeignKey(first[1] + '.id'),
+                  nullable=not keyed),
+        sa.Column(second[0], sa.Integer, sa.ForeignKey(second[1] + '.id'),
+                  nullable=not keyed),
+    ]
+    if voted:
+        columns.append(sa.Column('direction', sa.SmallInteger, nullable=False,
+                                 server_default='1'))
+    if keyed:
+        columns.append(sa.PrimaryKeyConstraint(first[0], second[0],
+                                               name='pk_' + name))
+    op.create_table(tmp, *columns)
+
+    # Duplicate pairs collapse into one row; a pair that was voted on more
+    # than once keeps the highest direction.
+    keys = '{}, {}'.format(first[0], second[0])
+    direction = ''
+    if voted:
+        direction = ', MAX(direction)' if has_direction else ', 1'
+    op.execute(
+        'INSERT INTO {tmp} ({keys}{target}) SELECT {keys}{direction} FROM {name} '
+        'WHERE {a} IS NOT NULL AND {b} IS NOT NULL GROUP BY {keys}'.format(
+            tmp=tmp, name=name, keys=keys, a=first[0], b=second[0],
+            target=', direction' if voted else '', direction=direction,
+        )
+    )
+    op.drop_table(name)
+    op.rename_table(tmp, name)
+    if keyed:
+        op.create_index('ix_{}_{}'.format(name, second[0]), name, [second[0]])
+
+
+def upgrade():
+    for name, (first, second, voted) in TABLES.items():
+        rebuild(name, first, second, voted, keyed=True)
+
+
+def downgrade():
+    for name, (first, second, voted) in TABLES.items():
+        rebuild(name, first, second, voted, keyed=False)
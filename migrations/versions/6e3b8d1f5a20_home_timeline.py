@@ -0,0 +1,37 @@
+"""home timeline
+
+Revision ID: 6e3b8d1f5a20
+Revises: 1f0c9a2d7b64
+Create Date: 2026-10-18 08:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e3b8d1f5a20'
+down_revision = '1f0c9a2d7b64'
+branch_labels = None
+depends_on = None
+
+
+# The table starts empty; run `flask timeline rebuild` once to fill it from
+# the existing follows and memberships.
+def upgrade():
+    op.create_table(
+        'timeline',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['post_id'], ['post.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('user_id', 'post_id'),
+    )
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline',
+                    ['user_id', 'timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.drop_table('timeline')
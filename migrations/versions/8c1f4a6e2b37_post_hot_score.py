@@ -0,0 +1,33 @@
+"""post hot score
+
+Revision ID: 8c1f4a6e2b37
+Revises: 5b2e7c41d0a9
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1f4a6e2b37'
+down_revision = '5b2e7c41d0a9'
+branch_labels = None
+depends_on = None
+
+
+# Existing posts start at 0; run `flask ranking decay` once to backfill the
+# posts that are still inside the ranking horizon.
+def upgrade():
+    op.add_column('post', sa.Column('hot', sa.Float(), server_default='0'))
+    op.create_index('ix_post_communityid_hot', 'post',
+                    ['communityid', 'hot', 'id'])
+    op.create_index('ix_post_communityid_timestamp', 'post',
+                    ['communityid', 'timestamp', 'karma'])
+
+
+def downgrade():
+    op.drop_index('ix_post_communityid_timestamp', table_name='post')
+    op.drop_index('ix_post_communityid_hot', table_name='post')
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.drop_column('hot')
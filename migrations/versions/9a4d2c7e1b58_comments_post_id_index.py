@@ -0,0 +1,24 @@
+"""comments post_id index
+
+Revision ID: 9a4d2c7e1b58
+Revises: 6e3b8d1f5a20
+Create Date: 2026-10-18 08:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4d2c7e1b58'
+down_revision = '6e3b8d1f5a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_comments_post_id', 'comments', ['post_id'])
+
+
+def downgrade():
+    op.drop_index('ix_comments_post_id', table_name='comments')
@@ -0,0 +1,32 @@
+"""notification upserts
+
+Revision ID: a47c2d9e8f15
+Revises: 3d9a5e07c6f2
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a47c2d9e8f15'
+down_revision = '3d9a5e07c6f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Only the newest row per (user_id, name) was ever read back.
+    op.execute(
+        'DELETE FROM notification WHERE id NOT IN ('
+        'SELECT MAX(id) FROM notification GROUP BY user_id, name)'
+    )
+    op.create_index('uq_notification_user_id_name', 'notification',
+                    ['user_id', 'name'], unique=True)
+    op.create_index('ix_notification_user_id_timestamp', 'notification',
+                    ['user_id', 'timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
+    op.drop_index('uq_notification_user_id_name', table_name='notification')
@@ -0,0 +1,61 @@
+"""comment threads
+
+Revision ID: c2e81b5f9d43
+Revises: a47c2d9e8f15
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2e81b5f9d43'
+down_revision = 'a47c2d9e8f15'
+branch_labels = None
+depends_on = None
+
+
+PADDED_ID = {
+    'sqlite': "printf('%010d', id)",
+    'postgresql': "lpad(id::text, 10, '0')",
+    'mysql': "LPAD(id, 10, '0')",
+}
+
+
+def upgrade():
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.add_column(sa.Column('parent_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('root_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('path', sa.String(length=255),
+                                      nullable=True))
+        batch_op.add_column(sa.Column('depth', sa.Integer(), server_default='0',
+                                      nullable=True))
+        batch_op.add_column(sa.Column('descendant_count', sa.Integer(),
+                                      server_default='0', nullable=True))
+        batch_op.add_column(sa.Column('reply_count', sa.Integer(),
+                                      server_default='0', nullable=True))
+        batch_op.create_foreign_key('fk_comments_parent_id', 'comments',
+                                    ['parent_id'], ['id'])
+    # Every existing comment becomes the root of its own thread.
+    padded = PADDED_ID[op.get_bind().dialect.name]
+    op.execute(
+        'UPDATE comments SET root_id = id, path = {}, depth = 0, '
+        'descendant_count = 0, reply_count = 0'.format(padded)
+    )
+    op.create_index('ix_comments_post_id_root_id_path', 'comments',
+                    ['post_id', 'root_id', 'path', 'depth'])
+    op.create_index('ix_comments_post_id_depth_timestamp', 'comments',
+                    ['post_id', 'depth', 'timestamp', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_comments_post_id_depth_timestamp', table_name='comments')
+    op.drop_index('ix_comments_post_id_root_id_path', table_name='comments')
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_column('reply_count')
+        batch_op.drop_column('descendant_count')
+        batch_op.drop_column('depth')
+        batch_op.drop_column('path')
+        batch_op.drop_column('root_id')
+        batch_op.drop_column('parent_id')
@@ -0,0 +1,31 @@
+"""post search
+
+Revision ID: d5f7a3b9c1e2
+Revises: 2b7e9f4c6a13
+Create Date: 2026-10-18 08:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5f7a3b9c1e2'
+down_revision = '2b7e9f4c6a13'
+branch_labels = None
+depends_on = None
+
+
+# Only the SQLite backend keeps its index in the database. Elasticsearch
+# deployments fill theirs with `flask reindex`.
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(body)')
+    op.execute('INSERT INTO post_search (rowid, body) SELECT id, body FROM post')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE IF EXISTS post_search')
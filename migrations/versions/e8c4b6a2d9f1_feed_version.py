@@ -0,0 +1,31 @@
+"""feed version
+
+Revision ID: e8c4b6a2d9f1
+Revises: d5f7a3b9c1e2
+Create Date: 2026-10-18 08:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c4b6a2d9f1'
+down_revision = 'd5f7a3b9c1e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'feed_version',
+        sa.Column('kind', sa.String(length=16), nullable=False),
+        sa.Column('ref_id', sa.Integer(), nullable=False),
+        sa.Column('shard', sa.SmallInteger(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('kind', 'ref_id', 'shard'),
+    )
+
+
+def downgrade():
+    op.drop_table('feed_version')
@@ -1,12 +1,34 @@
 from datetime import datetime, timedelta
+from time import time
 import unittest
+from flask import g
 from app import app, db
-from app.models import User, Post
+from app.models import User, Post, Community, Comment, Message, hot_score
+from app.models import Conversation, ConversationMember, Notification
+from app.models import followers, voted_by, voted_by_comm, users_in_communities
+from app.models import feed_version, touch
+from app.pagination import keyset_paginate
+from app.last_seen import LastSeenBuffer, MemoryStore, get_buffer
+from app.votes import apply_votes
+from app.search import get_queue
+from sqlalchemy import text
+from sqlalchemy.orm import undefer
+from app import email
+from app.notify import get_broker
+from app.fragments import get_cache
+from app import identicons, identity, bench, metrics, engine, ranking, models
+from app import api, conditional, timeline
+import gzip
+import json
+import os
+import tempfile
+from app.seed import seed
 
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        app.config["SEARCH_QUEUE"] = "sync"
         db.create_all()
 
     def tearDown(self):
@@ -84,6 +106,1002 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_fanout(self):
+        app.config["TIMELINE_ENABLED"] = True
+        try:
+            u1 = User(username="john", email="john@example.com")
+            u2 = User(username="susan", email="susan@example.com")
+            u3 = User(username="mary", email="mary@example.com")
+            c = Community(name="cats", about="cats")
+            db.session.add_all([u1, u2, u3, c])
+            db.session.commit()
+
+            now = datetime.utcnow()
+            p1 = Post(body="old from susan", author=u2, timestamp=now)
+            db.session.add(p1)
+            db.session.commit()
+
+            u1.follow(u2)
+            c.followcomm(u1)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [p1])
+
+            p2 = Post(
+                body="cats from mary",
+                author=u3,
+                communityid=c.id,
+                timestamp=now + timedelta(seconds=1),
+            )
+            p3 = Post(
+                body="cats from susan",
+                author=u2,
+                communityid=c.id,
+                timestamp=now + timedelta(seconds=2),
+            )
+            p4 = Post(body="own", author=u1, timestamp=now + timedelta(seconds=3))
+            db.session.add_all([p2, p3, p4])
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), u1.followed_posts().all())
+            self.assertEqual(u1.timeline_posts().all(), [p4, p3, p2, p1])
+
+            u1.unfollow(u2)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [p4, p3, p2])
+
+            c.unfollowcomm(u1)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [p4])
+
+            db.session.delete(p4)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [])
+        finally:
+            app.config["TIMELINE_ENABLED"] = False
+
+    def test_timeline_push_is_idempotent(self):
+        app.config["TIMELINE_ENABLED"] = True
+        try:
+            u1 = User(username="john", email="john@example.com")
+            u2 = User(username="susan", email="susan@example.com")
+            p = Post(body="from susan", author=u2)
+            db.session.add_all([u1, u2, p])
+            db.session.commit()
+            u1.follow(u2)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [p])
+
+            timeline.push_post(db.session.connection(), p.id)
+            timeline.push_post(db.session.connection(), p.id)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [p])
+            self.assertEqual(u2.timeline_posts().all(), [p])
+        finally:
+            app.config["TIMELINE_ENABLED"] = False
+
+    def test_recount_counters(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        p = Post(body="post from john", author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        db.session.add_all(
+            [Comment(body="hi", post=p, author_id=u2.id) for _ in range(3)]
+        )
+        db.session.add_all(
+            [Message(author=u1, recipient=u2, body="hi") for _ in range(2)]
+        )
+        db.session.commit()
+        self.assertEqual(p.comment_count, 0)
+        self.assertEqual(u2.new_messages(), 0)
+
+        User.recount_unread_messages()
+        Post.recount_comments()
+        db.session.commit()
+        self.assertEqual(p.comment_count, 3)
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(u1.new_messages(), 0)
+
+        u2.last_message_read_time = datetime.utcnow() + timedelta(seconds=1)
+        db.session.commit()
+        User.recount_unread_messages()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+
+    def test_last_seen_buffer(self):
+        old = datetime.utcnow() - timedelta(hours=1)
+        u1 = User(username="john", email="john@example.com", last_seen=old)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u2.last_seen = datetime.utcnow()
+
+        buffer = LastSeenBuffer(MemoryStore())
+        buffer.touch(u1)
+        buffer.touch(u2)
+        self.assertEqual(list(buffer.store.pending), [u1.id])
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.flush(), 0)
+        db.session.expire_all()
+        self.assertGreater(u1.last_seen, old)
+
+    def test_karmachange(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        p = Post(body="post from john", author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+
+        self.assertTrue(p.karmachange(u2, "-", u1))
+        self.assertFalse(p.karmachange(u2, "+", u1))
+        self.assertFalse(p.karmachange(u1, "?", u1))
+        self.assertEqual(p.karma, -1)
+        self.assertEqual(u1.karma, -1)
+        self.assertTrue(p.is_voted(u2))
+
+    def test_apply_votes(self):
+        users = [
+            User(username="user%d" % i, email="user%d@example.com" % i)
+            for i in range(4)
+        ]
+        p = Post(body="post", author=users[0])
+        c = Comment(body="comment", post=p, author_id=1)
+        db.session.add_all(users + [p, c])
+        db.session.commit()
+        stream = [{"user_id": u.id, "post_id": p.id, "change": "+"} for u in users]
+        stream += [
+            {"user_id": users[1].id, "post_id": p.id, "change": "-"},
+            {"user_id": users[2].id, "comment_id": c.id, "change": "-"},
+        ]
+        self.assertEqual(apply_votes(stream), 4)
+        self.assertEqual(p.karma, 3)
+        self.assertEqual(c.karma, -1)
+        self.assertEqual(users[0].karma, 2)
+
+    def test_search(self):
+        u = User(username="john", email="john@example.com")
+        p1 = Post(body="cats and dogs", author=u)
+        p2 = Post(body="cats cats cats", author=u)
+        p3 = Post(body="only dogs", author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search("cats", 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(posts.all(), [p2, p1])
+        posts, total = Post.search("dogs", 2, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts.all()), 1)
+
+        p2.body = "birds"
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(Post.search("cats", 1, 10)[0].all(), [p1])
+        self.assertEqual(Post.search("dogs", 1, 10)[0].all(), [p1])
+        self.assertEqual(Post.search("!!", 1, 10)[1], 0)
+
+    def test_search_queue_and_reindex(self):
+        app.config["SEARCH_QUEUE"] = "thread"
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.add_all([Post(body="post %d" % i, author=u) for i in range(5)])
+        db.session.commit()
+        get_queue().join()
+        self.assertEqual(Post.search("post", 1, 10)[1], 5)
+
+        db.session.execute(text("DELETE FROM post_search"))
+        db.session.commit()
+        self.assertEqual(Post.search("post", 1, 10)[1], 0)
+        self.assertEqual(Post.reindex(chunk_size=2), 5)
+        self.assertEqual(Post.search("post", 1, 10)[1], 5)
+
+    def query_plan(self, query):
+        compiled = query.statement.compile(db.engine)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = db.session.connection().exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + str(compiled), params
+        )
+        return [row[-1] for row in rows]
+
+    def test_association_lookups_use_indexes(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        c = Community(name="cats", about="cats")
+        p = Post(body="post", author=u2)
+        comment = Comment(body="hi", post=p, author_id=2)
+        db.session.add_all([u1, u2, c, p, comment])
+        db.session.commit()
+        queries = {
+            "followers": [
+                u1.followed.filter(followers.c.followed_id == u2.id),
+                u2.followers,
+                u1.followed_posts(),
+            ],
+            "voted_by": [
+                p.voted_on.filter(voted_by.c.user_id == u1.id),
+                u1.voted_by,
+            ],
+            "voted_by_comm": [
+                comment.voted_on_comm.filter(voted_by_comm.c.user_id == u1.id)
+            ],
+            "users_in_communities": [
+                c.users_in_communities.filter(
+                    users_in_communities.c.user_id == u1.id
+                ),
+                Community.query.options(undefer(Community.member_count)).filter_by(
+                    id=c.id
+                ),
+            ],
+        }
+        for table, table_queries in queries.items():
+            for query in table_queries:
+                plan = self.query_plan(query)
+                self.assertTrue(
+                    any(step.startswith("SEARCH " + table + " ") for step in plan),
+                    plan,
+                )
+                self.assertNotIn("SCAN " + table, plan)
+        plain = self.query_plan(Community.query.filter_by(id=c.id))
+        self.assertFalse(any("users_in_communities" in step for step in plain))
+
+    def test_keyset_pagination(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        posts = [
+            Post(body=str(i), author=[u1, u2][i % 2], timestamp=now)
+            for i in range(10)
+        ]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = sorted([p.id for p in posts], reverse=True)
+        keys = (Post.timestamp, Post.id)
+
+        seen, cursor = [], None
+        while True:
+            with app.test_request_context(query_string={"cursor": cursor or ""}):
+                page = keyset_paginate(u1.followed_posts(), keys, per_page=3)
+            seen.extend(p.id for p in page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+        with app.test_request_context(query_string={"cursor": page.prev_cursor}):
+            prev = keyset_paginate(u1.followed_posts(), keys, per_page=3)
+        self.assertEqual([p.id for p in prev.items], expected[6:9])
+        self.assertTrue(prev.has_next)
+
+        with app.test_request_context(query_string={"page": 2}):
+            legacy = keyset_paginate(u1.followed_posts(), keys, per_page=3)
+        self.assertEqual([p.id for p in legacy.items], expected[3:6])
+        self.assertTrue(legacy.has_prev)
+
+    def test_hot_ranking(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        now = datetime.utcnow()
+        fresh = Post(body="fresh", author=u1, timestamp=now)
+        day_old = Post(body="older", author=u1, timestamp=now - timedelta(hours=20))
+        stale = Post(body="stale", author=u1, timestamp=now - timedelta(days=10))
+        db.session.add_all([u1, u2, fresh, day_old, stale])
+        db.session.commit()
+        self.assertAlmostEqual(fresh.hot, hot_score(0, now, now), 4)
+
+        day_old.karmachange(u2, "+", u1)
+        self.assertAlmostEqual(day_old.hot, hot_score(1, day_old.timestamp), 4)
+        db.session.execute(Post.__table__.update().values(hot=5.0))
+        db.session.commit()
+
+        later = now + timedelta(hours=1)
+        self.assertEqual(ranking.decay(batch_size=1, now=later), (2, 1))
+        self.assertEqual(stale.hot, 0)
+        self.assertAlmostEqual(fresh.hot, hot_score(0, now, later), 4)
+        self.assertGreater(fresh.hot, day_old.hot)
+
+        explore = Post.query.filter(Post.communityid == None)
+        with app.test_request_context(query_string={"sort": "top"}):
+            top = keyset_paginate(*ranking.ranked(explore, *ranking.sort_args()))
+        self.assertEqual([p.id for p in top.items], [day_old.id, fresh.id])
+
+        hot, keys = ranking.ranked(explore, "hot", "day")
+        plan = self.query_plan(hot.order_by(*[c.desc() for c in keys]))
+        self.assertTrue(any("ix_post_communityid_hot" in step for step in plan), plan)
+        self.assertFalse(any("TEMP B-TREE" in step for step in plan), plan)
+        top, keys = ranking.ranked(explore, "top", "week")
+        plan = self.query_plan(top.order_by(*[c.desc() for c in keys]))
+        self.assertTrue(
+            any("ix_post_communityid_timestamp" in step for step in plan), plan
+        )
+
+        step = app.config["TOP_WINDOW_STEP"]
+        start = ranking.window_start("day", now)
+        self.assertLessEqual(start, now - timedelta(days=1))
+        self.assertLess(now - timedelta(days=1) - start, timedelta(seconds=step))
+        boundary = start + timedelta(days=1)
+        self.assertEqual(
+            ranking.window_start("day", boundary + timedelta(seconds=step - 1)), start
+        )
+        self.assertGreater(
+            ranking.window_start("day", boundary + timedelta(seconds=step)), start
+        )
+
+    def test_feed_versions_are_sharded(self):
+        for _ in range(20):
+            touch("explore", 0)
+            db.session.commit()
+        shards = db.session.query(feed_version).filter_by(kind="explore").count()
+        self.assertGreater(shards, 1)
+        self.assertLessEqual(shards, app.config["FEED_VERSION_SHARDS"])
+        self.assertEqual(conditional.version("explore", 0), 20)
+
+    def test_notification_upserts(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.commit()
+        subscription = get_broker().subscribe(u.id)
+        try:
+            u.add_notification("unread_message_count", 1)
+            u.add_notification("unread_message_count", 2)
+            db.session.commit()
+            self.assertEqual(subscription.get(timeout=1)["data"], 2)
+            self.assertIsNone(subscription.get(timeout=0.01))
+            first = Notification.query.one()
+            stored = first.timestamp
+
+            u.add_notification("unread_message_count", 2)
+            db.session.commit()
+            db.session.expire_all()
+            self.assertEqual(Notification.query.one().timestamp, stored)
+
+            # Another worker stores 3; repeating 2 here must still land.
+            with db.engine.begin() as conn:
+                conn.execute(
+                    models.upsert(
+                        Notification.__table__,
+                        ["user_id", "name"],
+                        ["payload_json", "timestamp"],
+                        changed=["payload_json"],
+                    ),
+                    {
+                        "user_id": u.id,
+                        "name": "unread_message_count",
+                        "payload_json": "3",
+                        "timestamp": time(),
+                    },
+                )
+            u.add_notification("unread_message_count", 2)
+            db.session.commit()
+            events = [subscription.get(timeout=1), subscription.get(timeout=1)]
+            self.assertEqual([event["data"] for event in events], [2, 2])
+            db.session.expire_all()
+            self.assertEqual(Notification.query.one().get_data(), 2)
+
+            u.add_notification("unread_message_count", 3)
+            u.add_notification("other", "x")
+            db.session.commit()
+        finally:
+            subscription.close()
+        updated = Notification.query.filter_by(name="unread_message_count").one()
+        self.assertEqual((updated.id, updated.get_data()), (first.id, 3))
+
+        ttl = app.config["NOTIFICATION_TTL"]
+        self.assertEqual(Notification.compact(batch_size=1), 0)
+        self.assertEqual(Notification.compact(batch_size=1, now=time() + ttl + 1), 2)
+        self.assertEqual(Notification.query.count(), 0)
+
+        since = u.notifications.filter(Notification.timestamp > 0).order_by(
+            Notification.timestamp.asc()
+        )
+        plan = self.query_plan(since)
+        self.assertTrue(
+            any("ix_notification_user_id_timestamp" in step for step in plan), plan
+        )
+
+
+class QueryCountCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        app.config["WTF_CSRF_ENABLED"] = False
+        app.config["SECRET_KEY"] = "test"
+        app.config["SEARCH_QUEUE"] = "sync"
+        identity._cache = None
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def populate(self, n):
+        users = [
+            User(username="user%d" % i, email="user%d@example.com" % i)
+            for i in range(n + 1)
+        ]
+        for u in users:
+            u.set_password("cat")
+        c = Community(name="cats", about="cats")
+        db.session.add_all(users + [c])
+        db.session.commit()
+        reader = users[0]
+        c.followcomm(reader)
+        for u in users[1:]:
+            reader.follow(u)
+            post = Post(body="from " + u.username, author=u)
+            if u.id % 2:
+                post.communityid = c.id
+            db.session.add(post)
+        db.session.commit()
+        target = Post.query.first()
+        for u in users:
+            db.session.add(Comment(body="hi", post=target, author_id=u.id))
+        db.session.commit()
+        urls = {
+            "index": "/index",
+            "explore": "/explore",
+            "user": "/user/user1",
+            "community": "/community/%d" % c.id,
+            "communities": "/communities",
+            "post": "/post/%d" % target.id,
+        }
+        self.client.post("/login", data={"username": "user0", "password": "cat"})
+        return urls
+
+    def statements(self, url):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        return statements
+
+    def count_queries(self, url):
+        return len(self.statements(url))
+
+    def test_counters_follow_routes(self):
+        urls = self.populate(2)
+        post_id = int(urls["post"].rsplit("/", 1)[1])
+        self.client.post(urls["post"], data={"body": "another"})
+        self.assertEqual(Post.query.get(post_id).comment_count, 1)
+        comment = Comment.query.filter_by(body="another").first()
+        self.client.get("/deletecomm/%d" % comment.id, headers={"Referer": "/"})
+        self.assertEqual(Post.query.get(post_id).comment_count, 0)
+
+        self.client.post("/send_message/user1", data={"message": "hi"})
+        self.client.post("/send_message/user1", data={"message": "hi"})
+        recipient = User.query.filter_by(username="user1")
+        self.assertEqual(recipient.first().new_messages(), 2)
+        self.client.get("/deletemsg/%d" % Message.query.first().id)
+        self.assertEqual(recipient.first().new_messages(), 1)
+
+    def test_conversations(self):
+        self.populate(2)
+        for recipient in ("user1", "user1", "user2"):
+            self.client.post("/send_message/" + recipient, data={"message": "hi"})
+        self.client.get("/logout")
+        self.client.post("/login", data={"username": "user1", "password": "cat"})
+        user1 = User.query.filter_by(username="user1").first()
+        self.assertEqual(user1.new_messages(), 2)
+
+        statements = self.statements("/messages")
+        self.assertFalse(
+            [s for s in statements if s.split()[0] in ("INSERT", "UPDATE", "DELETE")]
+        )
+        self.assertIn(b"/messages/user0", self.client.get("/messages").data)
+        self.assertIn(b"hi", self.client.get("/messages/user0").data)
+        user1 = User.query.filter_by(username="user1").first()
+        self.assertEqual(user1.new_messages(), 0)
+        self.client.post("/send_message/user0", data={"message": "back"})
+
+        self.client.get("/logout")
+        self.client.post("/login", data={"username": "user0", "password": "cat"})
+        inbox = self.client.get("/messages").get_data(as_text=True)
+        self.assertLess(inbox.index("/messages/user1"), inbox.index("/messages/user2"))
+        self.assertIn("back", inbox)
+
+        summary = [
+            (m.user_id, m.peer_id, m.timestamp, m.unread_count)
+            for m in ConversationMember.query.order_by("user_id", "peer_id")
+        ]
+        ConversationMember.query.update({"unread_count": 5, "timestamp": None})
+        Conversation.query.update({"last_message_id": None, "timestamp": None})
+        Message.query.update({Message.conversation_id: None})
+        db.session.commit()
+        Conversation.rebuild()
+        db.session.commit()
+        self.assertEqual(
+            [
+                (m.user_id, m.peer_id, m.timestamp, m.unread_count)
+                for m in ConversationMember.query.order_by("user_id", "peer_id")
+            ],
+            summary,
+        )
+
+        reply = Message.query.filter_by(body="back").first()
+        self.client.get("/deletemsg/%d" % reply.id)
+        self.assertEqual(User.query.get(1).new_messages(), 0)
+        self.assertEqual(Conversation.query.count(), 2)
+
+    def test_threaded_comments(self):
+        urls = self.populate(1)
+        post_id = int(urls["post"].rsplit("/", 1)[1])
+        root = Comment.query.filter_by(post_id=post_id).first()
+        root_id = root.id
+        parent_id = root_id
+        for depth in range(1, 7):
+            self.client.post(
+                urls["post"] + "?reply_to=%d" % parent_id,
+                data={"body": "depth%d" % depth},
+            )
+            parent_id = Comment.query.filter_by(body="depth%d" % depth).one().id
+        for i in range(6):
+            self.client.post(
+                urls["post"] + "?reply_to=%d" % root_id, data={"body": "sibling%d" % i}
+            )
+        deepest = Comment.query.filter_by(body="depth6").one()
+        self.assertEqual(deepest.depth, 6)
+        self.assertEqual(deepest.root_id, root_id)
+        self.assertEqual(len(deepest.path.split(".")), 7)
+        self.assertEqual(Comment.query.get(root_id).descendant_count, 12)
+        self.assertEqual(Post.query.get(post_id).comment_count, 12)
+
+        statements = self.statements(urls["post"])
+        self.assertLessEqual(len([s for s in statements if "FROM comments" in s]), 2)
+        page = self.client.get(urls["post"]).get_data(as_text=True)
+        self.assertIn("depth4", page)
+        self.assertNotIn("depth5", page)
+        self.assertIn("Continue this thread (2 replies)", page)
+        self.assertIn("5 more replies", page)
+        self.assertIn("sibling0", page)
+        self.assertNotIn("sibling1", page)
+
+        thread_url = "%s/comments/%d" % (urls["post"], root_id)
+        self.assertIn("sibling5", self.client.get(thread_url).get_data(as_text=True))
+        with app.test_request_context():
+            subtree = keyset_paginate(
+                Comment.query.get(root_id).subtree(),
+                (Comment.path,),
+                per_page=5,
+                descending=False,
+            )
+        self.assertEqual(
+            [c.body for c in subtree.items][1:], ["depth%d" % i for i in range(1, 5)]
+        )
+
+        middle = Comment.query.filter_by(body="depth3").one()
+        voter = User.query.filter_by(username="user1").one()
+        db.session.execute(
+            voted_by_comm.insert(),
+            [
+                {"user_id": voter.id, "comments_id": voted}
+                for voted in (root_id, deepest.id)
+            ],
+        )
+        db.session.commit()
+        self.client.get("/deletecomm/%d" % middle.id, headers={"Referer": "/"})
+        self.assertEqual(
+            [row.comments_id for row in db.session.query(voted_by_comm)], [root_id]
+        )
+        self.assertEqual(Comment.query.filter(Comment.body.like("depth%")).count(), 2)
+        self.assertEqual(Comment.query.get(root_id).descendant_count, 8)
+        self.assertEqual(Comment.query.get(root_id).reply_count, 7)
+        self.assertEqual(Comment.query.filter_by(body="depth2").one().reply_count, 0)
+        self.assertEqual(Post.query.get(post_id).comment_count, 8)
+
+    def test_password_reset_email_is_captured(self):
+        self.populate(1)
+        self.client.get("/logout")
+        app.config["MAIL_CAPTURE"] = True
+        try:
+            self.client.post(
+                "/reset_password_request", data={"email": "user1@example.com"}
+            )
+        finally:
+            app.config["MAIL_CAPTURE"] = False
+        self.assertEqual(len(email.outbox), 1)
+        self.assertEqual(email.outbox.pop().recipients, ["user1@example.com"])
+
+    def test_notification_stream(self):
+        self.populate(1)
+        recipient = User.query.filter_by(username="user1").first()
+        subscription = get_broker().subscribe(recipient.id)
+        try:
+            self.client.post("/send_message/user1", data={"message": "hi"})
+            event = subscription.get(timeout=1)
+        finally:
+            subscription.close()
+        self.assertEqual(event["name"], "unread_message_count")
+        self.assertEqual(event["data"], 1)
+
+        self.client.post("/send_message/user0", data={"message": "hi"})
+        self.assertEqual(self.client.get("/notifications/stream").status_code, 404)
+        timeout = app.config["NOTIFICATION_STREAM_TIMEOUT"]
+        app.config["NOTIFICATION_PUSH"] = True
+        app.config["NOTIFICATION_STREAM_TIMEOUT"] = 0
+        try:
+            response = self.client.get(
+                "/notifications/stream", headers={"Last-Event-ID": "0"}
+            )
+        finally:
+            app.config["NOTIFICATION_PUSH"] = False
+            app.config["NOTIFICATION_STREAM_TIMEOUT"] = timeout
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertIn(b'"name": "unread_message_count"', response.data)
+
+    def test_cached_user_loader(self):
+        urls = self.populate(2)
+
+        def loads(url):
+            return [s for s in self.statements(url) if s.endswith("WHERE user.id = ?")]
+
+        self.assertEqual(len(loads(urls["explore"])), 1)
+        self.assertEqual(loads(urls["explore"]), [])
+        self.client.post("/edit_profile", data={"username": "user0", "about_me": "hi"})
+        self.assertEqual(len(loads(urls["explore"])), 1)
+        self.assertEqual(loads(urls["explore"]), [])
+        cache = identity.get_user_cache()
+        post = Post.query.filter(Post.user_id != 1).first()
+        cache.load(post.user_id)
+        key = str(post.user_id)
+        self.assertIsNotNone(cache.backend.get(key, key))
+        self.assertTrue(post.karmachange(User.query.get(1), "+", post.author))
+        self.assertIsNone(cache.backend.get(key, key))
+
+    def test_benchmark_harness(self):
+        counts = seed(
+            users=20,
+            posts=60,
+            comments=100,
+            votes=200,
+            messages=20,
+            communities=3,
+            follows=4,
+            celebrities=2,
+        )
+        self.assertEqual(Post.query.count(), counts["posts"])
+        self.assertEqual(
+            db.session.query(db.func.sum(Post.comment_count)).scalar(),
+            counts["comments"],
+        )
+        results = bench.run(iterations=2, warmup=1)
+        get_buffer().flush()
+        export = bench.export_throughput(gzip=True)
+        self.assertGreater(export["rows"], 1)
+        self.assertEqual(set(results), set(bench.ROUTES))
+        for result in results.values():
+            self.assertEqual(result["requests"], 2)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+            self.assertGreater(result["queries"], 0)
+
+    def test_request_metrics(self):
+        urls = self.populate(3)
+        self.client.get(urls["explore"])
+        queries = self.count_queries(urls["explore"])
+        app.debug = True
+        try:
+            response = self.client.get(urls["explore"])
+        finally:
+            app.debug = False
+        self.assertEqual(int(response.headers["X-DB-Queries"]), queries)
+        self.assertIn("db;dur=", response.headers["Server-Timing"])
+        body = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn('roblog_db_queries_count{endpoint="explore"}', body)
+        self.assertIn(
+            'roblog_request_duration_seconds_bucket{endpoint="explore",le="+Inf"}',
+            body,
+        )
+        with app.test_request_context("/explore"):
+            g.db_stats = metrics.RequestStats()
+            for _ in range(app.config["N_PLUS_ONE_THRESHOLD"]):
+                db.session.execute(text("SELECT 1"))
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                metrics.report(metrics.current_stats(), "explore")
+        self.assertIn("Possible N+1 in explore: 5 x SELECT 1", logs.output[0])
+
+    def test_replica_routing(self):
+        app.config["SQLALCHEMY_BINDS"] = {"replica0": "sqlite://"}
+        app.config["SQLALCHEMY_REPLICA_BINDS"] = ["replica0"]
+        try:
+            urls = self.populate(2)
+            replica = db.get_engine(bind="replica0")
+            db.Model.metadata.create_all(replica)
+            users = db.session.execute(User.__table__.select()).mappings().all()
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(), [dict(u) for u in users])
+                conn.execute(
+                    Post.__table__.insert(),
+                    {
+                        "body": "only on the replica",
+                        "user_id": 2,
+                        "timestamp": datetime.utcnow(),
+                    },
+                )
+            data = self.client.get(urls["explore"]).data
+            self.assertIn(b"only on the replica", data)
+            data = self.client.get(urls["index"]).data
+            self.assertNotIn(b"only on the replica", data)
+            self.client.post(urls["index"], data={"post": "fresh post"})
+            data = self.client.get(urls["explore"]).data
+            self.assertIn(b"fresh post", data)
+            self.assertNotIn(b"only on the replica", data)
+        finally:
+            app.config["SQLALCHEMY_BINDS"] = {}
+            app.config["SQLALCHEMY_REPLICA_BINDS"] = []
+
+    def test_api(self):
+        self.assertEqual(self.client.get("/api/v1/posts").status_code, 401)
+        urls = self.populate(3)
+        response = self.client.get("/api/v1/posts?fields=id,author&limit=2")
+        self.assertEqual(len(response.json["items"]), 2)
+        self.assertEqual(set(response.json["items"][0]), {"id", "author"})
+        cursor = response.json["next_cursor"]
+        response = self.client.get("/api/v1/posts?fields=id&limit=2&cursor=" + cursor)
+        self.assertEqual(len(response.json["items"]), 1)
+        self.assertIsNone(response.json["next_cursor"])
+        statements = self.statements("/api/v1/posts?fields=id,body")
+        self.assertFalse(any("JOIN" in s for s in statements))
+        response = self.client.get("/api/v1/users?ids=3,999,1")
+        self.assertEqual([u["id"] for u in response.json["items"]], [3, 1])
+        self.assertNotIn("email", response.json["items"][0])
+        api.RESOURCES["ranked"] = api.Resource(
+            User, {"username": User.username}, (User.karma,)
+        )
+        try:
+            response = self.client.get("/api/v1/ranked?ids=2,1")
+        finally:
+            del api.RESOURCES["ranked"]
+        self.assertEqual(
+            [u["username"] for u in response.json["items"]], ["user1", "user0"]
+        )
+        response = self.client.get("/api/v1/communities/1")
+        self.assertEqual(response.json["member_count"], 1)
+        response = self.client.get("/api/v1/comments?post_id=1&fields=author")
+        self.assertEqual(len(response.json["items"]), 4)
+        self.assertEqual(self.client.get("/api/v1/posts/999").status_code, 404)
+        response = self.client.get("/api/v1/posts?fields=password_hash")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("password_hash", response.json["error"])
+
+    def test_export_stream(self):
+        urls = self.populate(2)
+        self.assertEqual(self.client.get("/user/user1/export").status_code, 403)
+        response = self.client.get("/user/user0/export")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        records = [json.loads(line) for line in response.data.splitlines()]
+        kinds = [r["type"] for r in records]
+        self.assertEqual(kinds[0], "user")
+        self.assertEqual(records[0]["username"], "user0")
+        self.assertEqual(kinds.count("comment"), 1)
+        self.assertNotIn("post", kinds)
+        response = self.client.get("/user/user0/export?format=gzip")
+        lines = gzip.decompress(response.data).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], records)
+
+    def test_fragment_cache(self):
+        urls = self.populate(3)
+        stats = get_cache().stats()
+        self.client.get(urls["index"])
+        self.client.get(urls["index"])
+        self.assertEqual(get_cache().stats()["hits"] - stats["hits"], 3)
+        body = self.client.get("/metrics").get_data(as_text=True)
+        hits = get_cache().stats()["hits"]
+        self.assertIn("roblog_fragment_cache_hits_total {}".format(hits), body)
+        self.assertIn("# TYPE roblog_fragment_cache_hit_ratio gauge", body)
+
+        author = User.query.filter_by(username="user2").first()
+        target = Post.query.filter_by(user_id=author.id).first()
+        self.client.get("/%d/+" % target.id, headers={"Referer": "/"})
+        response = self.client.get(urls["user"].replace("user1", "user2"))
+        self.assertIn("&#127942 1", response.get_data(as_text=True))
+
+        self.assertNotIn("Delete Post", response.get_data(as_text=True))
+        self.client.get("/logout")
+        self.client.post("/login", data={"username": "user2", "password": "cat"})
+        mine = self.client.get(urls["user"].replace("user1", "user2"))
+        self.assertIn("Delete Post", mine.get_data(as_text=True))
+
+    def test_conditional_get(self):
+        urls = self.populate(2)
+        for route in ("index", "explore", "user", "community"):
+            first = self.client.get(urls[route])
+            self.assertTrue(first.headers.get("ETag"), route)
+            again = self.client.get(
+                urls[route], headers={"If-None-Match": first.headers["ETag"]}
+            )
+            self.assertEqual(again.status_code, 304, route)
+            self.assertEqual(again.data, b"")
+
+        before = self.client.get(urls["user"]).headers["ETag"]
+        target = Post.query.filter_by(body="from user1").first()
+        self.client.get("/%d/+" % target.id, headers={"Referer": "/"})
+        self.client.get(urls["index"])
+        after = self.client.get(urls["user"], headers={"If-None-Match": before})
+        self.assertEqual(after.status_code, 200)
+
+        before = self.client.get(urls["index"]).headers["ETag"]
+        self.client.post(urls["index"], data={"post": "hello"})
+        after = self.client.get(urls["index"], headers={"If-None-Match": before})
+        self.assertEqual(after.status_code, 200)
+
+        app.config["WTF_CSRF_ENABLED"] = True
+        try:
+            self.client.get(urls["index"])
+            before = self.client.get(urls["index"]).headers["ETag"]
+            same = self.client.get(urls["index"], headers={"If-None-Match": before})
+            with self.client.session_transaction() as session:
+                session["csrf_token"] = "rotated"
+            after = self.client.get(urls["index"], headers={"If-None-Match": before})
+        finally:
+            app.config["WTF_CSRF_ENABLED"] = False
+        self.assertEqual(same.status_code, 304)
+        self.assertEqual(after.status_code, 200)
+
+    def test_rename_refreshes_feeds(self):
+        urls = self.populate(3)
+        for route, username in (("explore", "user1"), ("community", "user2")):
+            before = self.client.get(urls[route]).headers["ETag"]
+            author = User.query.filter_by(username=username).first()
+            author.username = username + "x"
+            db.session.commit()
+            after = self.client.get(urls[route], headers={"If-None-Match": before})
+            self.assertEqual(after.status_code, 200, route)
+            self.assertIn(username + "x", after.get_data(as_text=True))
+
+    def test_queries_per_page_are_bounded(self):
+        small = {k: self.count_queries(v) for k, v in self.populate(2).items()}
+        self.tearDown()
+        self.setUp()
+        large = {k: self.count_queries(v) for k, v in self.populate(8).items()}
+        for route in small:
+            self.assertEqual(small[route], large[route], route)
+            self.assertLessEqual(large[route], 12, route)
+
+
+class AvatarCase(unittest.TestCase):
+    def setUp(self):
+        self.store = identicons._store
+        identicons._store = identicons.MemoryStore(16)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        identicons._store = self.store
+
+    def test_avatar_is_cached_and_immutable(self):
+        with app.test_request_context():
+            url = identicons.avatar_url(1, 100)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.data[:8], b"\x89PNG\r\n\x1a\n")
+        self.assertEqual(len(identicons._store.entries), 1)
+        self.assertEqual(self.client.get(url).data, response.data)
+        self.assertNotEqual(identicons.identicon(2, 100, "png"), response.data)
+        self.assertEqual(self.client.get("/avatar/1/37.png").status_code, 404)
+        with app.app_context():
+            count = identicons.pregenerate([1, 2])
+        formats = [fmt for fmt in identicons.FORMATS if identicons.supported(fmt)]
+        self.assertEqual(count, 2 * len(app.config["AVATAR_SIZES"]) * len(formats) - 1)
+
+
+class EngineProfileCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+            self.tmp, "app.db"
+        )
+
+    def tearDown(self):
+        db.engine.dispose()
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        os.remove(os.path.join(self.tmp, "app.db"))
+        os.rmdir(self.tmp)
+
+    def test_sqlite_pragmas(self):
+        with self.assertLogs(app.logger, "INFO") as logs:
+            settings = engine.check_engine()
+        self.assertEqual(settings["journal_mode"], "wal")
+        self.assertEqual(settings["synchronous"], "NORMAL")
+        self.assertEqual(settings["busy_timeout"], app.config["SQLITE_BUSY_TIMEOUT"])
+        self.assertEqual(settings["cache_size"], app.config["SQLITE_CACHE_SIZE"])
+        self.assertIn("journal_mode=wal", logs.output[0])
+
+
+class MailPoolCase(unittest.TestCase):
+    def test_pool_reuses_connection(self):
+        connections = []
+
+        class FakeConnection(object):
+            def __init__(self):
+                self.sent = []
+                connections.append(self)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def send(self, msg):
+                self.sent.append(msg)
+
+        connect = email.mail.connect
+        email.mail.connect = FakeConnection
+        try:
+            pool = email.MailPool(workers=1, maxsize=10)
+            for i in range(3):
+                pool.submit(email.Message("hi", sender="a@b.c", recipients=["d@e.f"]))
+            pool.queue.join()
+        finally:
+            email.mail.connect = connect
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(len(connections[0].sent), 3)
+        self.assertEqual(pool.stats()["sent"], 3)
+        self.assertEqual(pool.stats()["queued"], 0)
+
+    def test_pool_reconnects_after_dropped_connection(self):
+        connections = []
+
+        class FakeConnection(object):
+            def __init__(self):
+                self.sent = []
+                self.dropped = False
+                connections.append(self)
+
+            def __enter__(self):
+                if len(connections) > 2:
+                    raise OSError("refused")
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def send(self, msg):
+                if self.dropped:
+                    raise OSError("server closed the connection")
+                self.sent.append(msg)
+
+        connect = email.mail.connect
+        email.mail.connect = FakeConnection
+        try:
+            pool = email.MailPool(workers=1, maxsize=10)
+            msg = email.Message("hi", sender="a@b.c", recipients=["d@e.f"])
+            pool.submit(msg)
+            pool.queue.join()
+            connections[0].dropped = True
+            pool.submit(msg)
+            pool.queue.join()
+            connections[1].dropped = True
+            pool.submit(msg)
+            pool.queue.join()
+        finally:
+            email.mail.connect = connect
+        self.assertEqual([len(c.sent) for c in connections], [1, 1, 0])
+        self.assertEqual(pool.stats()["sent"], 2)
+        self.assertEqual(pool.stats()["failed"], 1)
+
+    def test_full_queue_drops_message(self):
+        pool = email.MailPool(workers=0, maxsize=1)
+        msg = email.Message("hi", sender="a@b.c", recipients=["d@e.f"])
+        self.assertTrue(pool.submit(msg))
+        start = time()
+        self.assertFalse(pool.submit(msg))
+        self.assertLess(time() - start, 0.1)
+        self.assertEqual(pool.stats()["dropped"], 1)
+        self.assertEqual(pool.stats()["queued"], 1)
+
+    def test_mail_metrics(self):
+        body = app.test_client().get("/metrics").get_data(as_text=True)
+        self.assertIn("# TYPE roblog_mail_queued gauge", body)
+        self.assertIn("roblog_mail_dropped_total {}".format(email.pool.dropped), body)
+        self.assertIn("roblog_mail_avg_latency_seconds ", body)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)